@@ -3,6 +3,8 @@ from __future__ import annotations
 import logging
 import psycopg2
 
+from pg_utils import prepare
+
 # ==== CONFIG CONNEXION ====
 
 import os
@@ -29,9 +31,9 @@ handler.setFormatter(logging.Formatter(
 log.addHandler(handler)
 
 
-def _exec_sql(conn, sql: str, params=None, label: str = ""):
+def _exec_sql(conn, sql: str, params, label: str):
     with conn.cursor() as cur:
-        log.info("SQL → %s", label or sql.splitlines()[0][:80] + "…")
+        log.info("SQL → %s", label)
         cur.execute(sql, params or ())
         try:
             rows = cur.rowcount
@@ -39,136 +41,237 @@ def _exec_sql(conn, sql: str, params=None, label: str = ""):
                 log.info("→ %s lignes affectées", rows)
         except Exception:
             pass
+        return cur.fetchone() if cur.description else None
+
+
+# Codes département Ameli → id_departement : métropole (01..95 hors 20,
+# et variantes sans zéro), Corse 2A/2B → 101/102, DROM, puis tout autre
+# code numérique de la staging. Remplace le CASE + regex évalué ligne à
+# ligne par une jointure sur ~110 lignes.
+_DEP_CODE_MAP_SQL = """
+    CREATE TABLE IF NOT EXISTS "pro_sante".dep_code_map (
+      code            text PRIMARY KEY,
+      id_departement  int  NOT NULL
+    );
+    INSERT INTO "pro_sante".dep_code_map (code, id_departement)
+    SELECT lpad(n::text, 2, '0'), n FROM generate_series(1, 95) n WHERE n <> 20
+    UNION ALL
+    SELECT n::text, n FROM generate_series(1, 9) n
+    UNION ALL
+    SELECT code, id FROM (VALUES
+      ('2A', 101), ('2B', 102),
+      ('971', 971), ('972', 972), ('973', 973), ('974', 974), ('976', 976)
+    ) v(code, id)
+    ON CONFLICT (code) DO NOTHING;
+    -- tout autre code numérique présent en staging (ex. 975, 977, 978) :
+    -- id = code::int, comme l'ancien CASE
+    INSERT INTO "pro_sante".dep_code_map (code, id_departement)
+    SELECT DISTINCT departement, departement::int
+    FROM "pro_sante".stg_pro_sante_raw
+    WHERE departement ~ '^[0-9]+$'
+    ON CONFLICT (code) DO NOTHING;
+"""
+
+
+def ensure_dep_code_map(conn) -> None:
+    """
+    Crée / complète pro_sante.dep_code_map (code département → id,
+    Corse 2A/2B → 101/102). Idempotent ; utilisé aussi par facts_loader
+    (chargement des faits sans passer par les dimensions).
+    """
+    _exec_sql(conn, _DEP_CODE_MAP_SQL, None, "TABLE dep_code_map")
+
+
+# Upsert des six dimensions en une lecture de la staging ({year_filter} :
+# vide, ou "AND annee = $1" pour la variante paramétrée par année)
+_DIMS_SQL = """
+    WITH s AS MATERIALIZED (
+      SELECT DISTINCT
+        annee, profession_sante, libelle_region, libelle_sexe,
+        classe_age, libelle_classe_age, departement, libelle_departement
+      FROM "pro_sante".stg_pro_sante_raw
+      WHERE region <> '99'
+        AND departement <> '999'
+        AND libelle_sexe IN ('hommes','femmes')
+        AND classe_age <> 'tout_age'
+        {year_filter}
+    ),
+    ins_annee AS (
+      INSERT INTO "pro_sante".annees (annee)
+      SELECT DISTINCT annee FROM s
+      ON CONFLICT (annee) DO NOTHING
+      RETURNING 1
+    ),
+    ins_profession AS (
+      INSERT INTO "pro_sante".professions (profession)
+      SELECT DISTINCT profession_sante FROM s
+      ON CONFLICT (profession) DO NOTHING
+      RETURNING 1
+    ),
+    ins_region AS (
+      INSERT INTO "pro_sante".regions (libelle_region)
+      SELECT DISTINCT libelle_region FROM s
+      ON CONFLICT (libelle_region) DO NOTHING
+      RETURNING id_region, libelle_region
+    ),
+    ins_genre AS (
+      INSERT INTO "pro_sante".genres (libelle_sexe)
+      SELECT DISTINCT libelle_sexe FROM s
+      ON CONFLICT (libelle_sexe) DO NOTHING
+      RETURNING 1
+    ),
+    ins_tranche AS (
+      INSERT INTO "pro_sante".tranches_age (classe_age, libelle_classe_age)
+      SELECT DISTINCT classe_age, libelle_classe_age FROM s
+      ON CONFLICT (classe_age) DO UPDATE
+      SET libelle_classe_age = EXCLUDED.libelle_classe_age
+      RETURNING 1
+    ),
+    /* Les régions insérées dans cette même requête ne sont pas
+       visibles via la table (snapshot unique) → on les reprend
+       depuis RETURNING */
+    r AS (
+      SELECT id_region, libelle_region FROM ins_region
+      UNION ALL
+      SELECT id_region, libelle_region FROM "pro_sante".regions
+    ),
+    n AS (
+      SELECT
+        m.id_departement,
+        s.libelle_departement AS nom_departement,
+        s.libelle_region
+      FROM s
+      JOIN "pro_sante".dep_code_map m ON m.code = s.departement
+    ),
+    ins_departement AS (
+      INSERT INTO "pro_sante".departements (id_departement, nom_departement, id_region)
+      SELECT DISTINCT
+        n.id_departement,
+        n.nom_departement,
+        r.id_region
+      FROM n
+      JOIN r ON r.libelle_region = n.libelle_region
+      ON CONFLICT (id_departement) DO UPDATE
+      SET nom_departement = EXCLUDED.nom_departement,
+          id_region       = EXCLUDED.id_region
+      RETURNING 1
+    )
+    SELECT
+      (SELECT count(*) FROM ins_annee),
+      (SELECT count(*) FROM ins_profession),
+      (SELECT count(*) FROM ins_region),
+      (SELECT count(*) FROM ins_genre),
+      (SELECT count(*) FROM ins_tranche),
+      (SELECT count(*) FROM ins_departement)
+"""
+
+# Existe-t-il une ligne de staging dont une valeur de dimension manque
+# (ou diffère pour les libellés mis à jour) ? Lecture seule. Les anti-jointures
+# portent sur les n-uplets DISTINCT (quelques milliers) et non sur chaque
+# ligne de staging : plus de SubPlan corrélé par ligne.
+_DIMS_MISSING_SQL = """
+    WITH v AS MATERIALIZED (
+      SELECT DISTINCT s.annee, s.profession_sante, s.libelle_region,
+             s.departement, s.libelle_departement, s.libelle_sexe,
+             s.classe_age, s.libelle_classe_age
+      FROM "pro_sante".stg_pro_sante_raw s
+      WHERE s.region <> '99'
+        AND s.departement <> '999'
+        AND s.libelle_sexe IN ('hommes','femmes')
+        AND s.classe_age <> 'tout_age'
+        {year_filter}
+    )
+    SELECT EXISTS (SELECT 1 FROM v LEFT JOIN "pro_sante".annees a
+                     ON a.annee = v.annee
+                   WHERE a.annee IS NULL)
+        OR EXISTS (SELECT 1 FROM v LEFT JOIN "pro_sante".professions p
+                     ON p.profession = v.profession_sante
+                   WHERE p.profession IS NULL)
+        OR EXISTS (SELECT 1 FROM v LEFT JOIN "pro_sante".regions r
+                     ON r.libelle_region = v.libelle_region
+                   WHERE r.libelle_region IS NULL)
+        OR EXISTS (SELECT 1 FROM v LEFT JOIN "pro_sante".genres g
+                     ON g.libelle_sexe = v.libelle_sexe
+                   WHERE g.libelle_sexe IS NULL)
+        OR EXISTS (SELECT 1 FROM v LEFT JOIN "pro_sante".tranches_age t
+                     ON t.classe_age = v.classe_age
+                    AND t.libelle_classe_age IS NOT DISTINCT FROM v.libelle_classe_age
+                   WHERE t.classe_age IS NULL)
+        OR EXISTS (SELECT 1
+                   FROM v
+                   JOIN "pro_sante".dep_code_map m ON m.code = v.departement
+                   LEFT JOIN ("pro_sante".departements d
+                              JOIN "pro_sante".regions r
+                                ON r.id_region = d.id_region)
+                     ON d.id_departement = m.id_departement
+                    AND d.nom_departement IS NOT DISTINCT FROM v.libelle_departement
+                    AND r.libelle_region = v.libelle_region
+                   WHERE d.id_departement IS NULL)
+"""
+
+# Ordre des compteurs renvoyés par la requête des dimensions
+DIM_LABELS = ("annee", "profession", "region",
+              "genre", "tranche_age", "departement")
 
 
-def populate_dimensions(year: int | None = None):
+def populate_dimensions(conn, year: int | None = None):
     """
     Étape 3 — Remplit/actualise les dimensions depuis la staging.
     Si 'year' est fourni, filtre la staging sur cette année.
+    La connexion est fournie par l'appelant (pipeline_runner ou main).
+    Une seule lecture de la staging (CTE MATERIALIZED) alimente les six
+    dimensions via une chaîne de CTE d'écriture ; elle est sautée si un
+    contrôle préalable ne trouve aucune valeur manquante.
     """
-    year_filter = "AND annee = %s" if year is not None else ""
     params = (year,) if year is not None else tuple()
 
-    with psycopg2.connect(**PG_CONN) as conn:
-        # Années
-        _exec_sql(conn, f"""
-            WITH s AS (
-              SELECT * FROM "pro_sante".stg_pro_sante_raw
-              WHERE region <> '99'
-                AND departement <> '999'
-                AND libelle_sexe IN ('hommes','femmes')
-                AND classe_age <> 'tout_age'
-                {year_filter}
-            )
-            INSERT INTO "pro_sante".annees (annee)
-            SELECT DISTINCT annee FROM s
-            ON CONFLICT (annee) DO NOTHING;
-        """, params, "DIM annee")
-
-        # Professions
-        _exec_sql(conn, f"""
-            WITH s AS (
-              SELECT * FROM "pro_sante".stg_pro_sante_raw
-              WHERE region <> '99'
-                AND departement <> '999'
-                AND libelle_sexe IN ('hommes','femmes')
-                AND classe_age <> 'tout_age'
-                {year_filter}
-            )
-            INSERT INTO "pro_sante".professions (profession)
-            SELECT DISTINCT profession_sante FROM s
-            ON CONFLICT (profession) DO NOTHING;
-        """, params, "DIM profession")
-
-        # Régions
-        _exec_sql(conn, f"""
-            WITH s AS (
-             SELECT * FROM "pro_sante".stg_pro_sante_raw
-            WHERE region <> '99'
-                AND departement <> '999'
-                AND libelle_sexe IN ('hommes','femmes')
-                AND classe_age <> 'tout_age'
-                {year_filter}
-    )
-        INSERT INTO "pro_sante".regions (libelle_region)
-        SELECT DISTINCT libelle_region FROM s
-        ON CONFLICT (libelle_region) DO NOTHING;
-        """, params, "DIM region")
-
-        # Genres
-        _exec_sql(conn, f"""
-            WITH s AS (
-              SELECT * FROM "pro_sante".stg_pro_sante_raw
-              WHERE region <> '99'
-                AND departement <> '999'
-                AND libelle_sexe IN ('hommes','femmes')
-                AND classe_age <> 'tout_age'
-                {year_filter}
-            )
-            INSERT INTO "pro_sante".genres (libelle_sexe)
-            SELECT DISTINCT libelle_sexe FROM s
-            ON CONFLICT (libelle_sexe) DO NOTHING;
-        """, params, "DIM genre")
-
-        # Tranches d'âge
-        _exec_sql(conn, f"""
-            WITH s AS (
-              SELECT * FROM "pro_sante".stg_pro_sante_raw
-              WHERE region <> '99'
-                AND departement <> '999'
-                AND libelle_sexe IN ('hommes','femmes')
-                AND classe_age <> 'tout_age'
-                {year_filter}
-            )
-            INSERT INTO "pro_sante".tranches_age (classe_age, libelle_classe_age)
-            SELECT DISTINCT classe_age, libelle_classe_age FROM s
-            ON CONFLICT (classe_age) DO UPDATE
-            SET libelle_classe_age = EXCLUDED.libelle_classe_age;
-        """, params, "DIM tranche_age")
-
-        # Départements (avec fk région)
-        _exec_sql(conn, f"""
-            WITH s AS (
-                SELECT *
-                FROM "pro_sante".stg_pro_sante_raw
-                WHERE region <> '99'
-                AND departement <> '999'
-                AND libelle_sexe IN ('hommes','femmes')
-                AND classe_age <> 'tout_age'
-                {year_filter}
-    ),
-            n AS (
-            SELECT
-                CASE
-                WHEN departement = '2A' THEN 101
-                WHEN departement = '2B' THEN 102
-                WHEN departement ~ '^[0-9]+$' THEN departement::int
-                ELSE NULL
-                END AS id_departement,
-                libelle_departement AS nom_departement,
-                libelle_region
-                FROM s
-    )
-        INSERT INTO "pro_sante".departements (id_departement, nom_departement, id_region)
-        SELECT DISTINCT
-          n.id_departement,
-          n.nom_departement,
-          r.id_region
-        FROM n
-        JOIN "pro_sante".regions r ON r.libelle_region = n.libelle_region
-        WHERE n.id_departement IS NOT NULL
-        ON CONFLICT (id_departement) DO UPDATE
-        SET nom_departement = EXCLUDED.nom_departement,
-        id_region       = EXCLUDED.id_region;
-""", params, "DIM departement")
+    ensure_dep_code_map(conn)
 
+    # Index partiel couvrant : le filtre de validité devient un
+    # Index-Only Scan (dims + faits partagent ce prédicat)
+    _exec_sql(conn, """
+        CREATE INDEX IF NOT EXISTS idx_stg_valid
+        ON "pro_sante".stg_pro_sante_raw (annee)
+        INCLUDE (profession_sante, region, libelle_region,
+                 departement, libelle_departement,
+                 classe_age, libelle_classe_age, libelle_sexe,
+                 effectif, densite)
+        WHERE region <> '99'
+          AND departement <> '999'
+          AND libelle_sexe IN ('hommes','femmes')
+          AND classe_age <> 'tout_age';
+    """, None, "INDEX idx_stg_valid")
+
+    # Relance idempotente : rien à écrire si toutes les valeurs existent déjà
+    (missing,) = _exec_sql(conn, _DIMS_MISSING_SQL.format(
+        year_filter="AND s.annee = %s" if year is not None else ""),
+        params, "DIM contrôle des valeurs manquantes")
+    if not missing:
         conn.commit()
-        log.info("[OK] Dimensions peuplées%s", f" pour {year}" if year else "")
+        log.info("[OK] Dimensions déjà complètes%s → skip",
+                 f" pour {year}" if year else "")
+        return
+
+    name = "dims_upsert" if year is not None else "dims_upsert_all"
+    prepare(conn, name, _DIMS_SQL.format(
+        year_filter="AND annee = $1" if year is not None else ""))
+    counts = _exec_sql(conn, f"EXECUTE {name}" + ("(%s)" if year is not None else ""),
+                       params, "DIM annee/profession/region/genre/tranche_age/departement")
+
+    for label, n in zip(DIM_LABELS, counts):
+        log.info("→ DIM %s : %s lignes affectées", label, n)
+
+    conn.commit()
+    log.info("[OK] Dimensions peuplées%s", f" pour {year}" if year else "")
 
 
 # ==== MAIN ====
-def main(year: int | None = None):
-    populate_dimensions(year)
+def main(year: int | None = None, conn=None):
+    if conn is not None:
+        populate_dimensions(conn, year)
+        return
+    with psycopg2.connect(**PG_CONN) as conn:
+        populate_dimensions(conn, year)
 
 
 if __name__ == "__main__":
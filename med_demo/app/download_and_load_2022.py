@@ -1,10 +1,16 @@
 import os
 import sys
-from io import StringIO
 from pathlib import Path
 import urllib.parse as ul
-import pandas as pd
+from typing import Iterable, Iterator
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import psycopg2
+from parquet_http import open_parquet_url, year_filter
+from pg_copy import copy_batches_binary, temp_table_ddl
+from pg_utils import STAGING_COLS, STAGING_UPSERT_SQL, staging_col_types
 
 # ========= PARAMS =========
 YEAR = 2022
@@ -17,6 +23,12 @@ DROP_DIR = Path(os.getenv(
 ))
 OUT_FILE = DROP_DIR / f"pro_sante_{YEAR}.parquet"
 
+# Taille des lots d'UPSERT staging (une transaction par lot)
+UPSERT_BATCH = 10_000
+
+# Lignes décodées / préparées / envoyées au COPY à la fois
+STREAM_BATCH = 100_000
+
 # URL data.ameli → export Parquet filtré sur l'année
 AMELI_URL = (
     "https://data.ameli.fr/api/explore/v2.1/catalog/datasets/"
@@ -34,102 +46,199 @@ PG_CONN = dict(
 )
 
 # Colonnes attendues par la staging (ordre strict)
-COLS = [
-    "annee", "profession_sante", "region", "libelle_region",
-    "departement", "libelle_departement",
-    "classe_age", "libelle_classe_age", "libelle_sexe",
-    "effectif", "densite",
-    "vision_generale_all", "vision_generale_prescriptions", "vision_profession_territoire"
-]
-
-
-def fetch_parquet_df(url: str) -> pd.DataFrame:
+COLS = STAGING_COLS
+
+# Schéma Arrow cible de la préparation (mêmes colonnes/ordre que COLS)
+EXPECTED_SCHEMA = pa.schema([
+    ("annee", pa.int64()),
+    ("profession_sante", pa.string()),
+    ("region", pa.string()),
+    ("libelle_region", pa.string()),
+    ("departement", pa.string()),
+    ("libelle_departement", pa.string()),
+    ("classe_age", pa.string()),
+    ("libelle_classe_age", pa.string()),
+    ("libelle_sexe", pa.string()),
+    ("effectif", pa.int64()),
+    ("densite", pa.float64()),
+    ("vision_generale_all", pa.string()),
+    ("vision_generale_prescriptions", pa.string()),
+    ("vision_profession_territoire", pa.string()),
+])
+
+
+
+def fetch_parquet_batches(url: str, year: int) -> Iterator[pa.RecordBatch]:
     """
-    Lecture directe du Parquet en HTTP via pyarrow (pas d'écriture disque nécessaire).
+    Lecture du Parquet en HTTP via pyarrow (pas d'écriture disque nécessaire).
+    Seuls le footer et les column chunks de COLS sont rapatriés (GET Range
+    concurrents) et le filtre année est poussé au lecteur (élagage des row
+    groups par statistiques min/max).
+    Les lignes sont décodées par record batch de STREAM_BATCH lignes : un
+    seul batch décodé en mémoire à la fois.
     """
     print(f"[INFO] Lecture Parquet directe depuis l’URL…\n{url}")
-    df = pd.read_parquet(url, engine="pyarrow")
-    print(
-        f"[OK] Parquet chargé en mémoire: {len(df):,} lignes, {len(df.columns)} colonnes")
-    return df
-
+    fragment = open_parquet_url(url, columns=COLS, year=year)
 
-def prepare_dataframe(df: pd.DataFrame, year: int) -> pd.DataFrame:
-    for c in COLS:
-        if c not in df.columns:
-            df[c] = None
-    df = df[COLS]
+    schema = fragment.physical_schema
+    columns = [c for c in COLS if c in schema.names]
+    print(f"[OK] Parquet ouvert: {fragment.metadata.num_rows:,} lignes "
+          f"(avant filtre), {len(columns)} colonnes")
+    return fragment.to_batches(columns=columns,
+                               filter=year_filter(schema, year),
+                               batch_size=STREAM_BATCH)
 
-    # Harmoniser le type année (au cas où)
-    df["annee"] = pd.to_numeric(df["annee"], errors="coerce").astype("Int64")
 
-    df = df[df["annee"] == year].copy()
-    df["effectif"] = pd.to_numeric(df["effectif"], errors="coerce")
-    df["densite"] = pd.to_numeric(df["densite"],  errors="coerce")
-
-    print(f"[INFO] Après préparation: {len(df):,} lignes pour l’année {year}")
-    return df
+def _save_local(batches: Iterable[pa.RecordBatch],
+                path: Path) -> Iterator[pa.RecordBatch]:
+    """
+    Copie locale écrite au fil de l'eau (ParquetWriter), batches relayés.
+    """
+    writer = None
+    failed = False
+    try:
+        for batch in batches:
+            if not failed:
+                try:
+                    if writer is None:
+                        DROP_DIR.mkdir(parents=True, exist_ok=True)
+                        writer = pq.ParquetWriter(path, batch.schema)
+                    writer.write_batch(batch)
+                except Exception as e:
+                    # la copie locale est optionnelle : le chargement continue
+                    print(f"[WARN] Impossible d’écrire la copie locale: {e}")
+                    failed = True
+            yield batch
+    finally:
+        if writer is not None:
+            writer.close()
+            if not failed:
+                print(f"[INFO] Copie locale écrite → {path}")
+
+
+# Texte numérique accepté (comme pd.to_numeric) ; le reste devient NULL
+_NUMERIC_RE = r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$"
+
+
+def _to_numeric(arr: pa.ChunkedArray, typ: pa.DataType) -> pa.ChunkedArray:
+    """
+    Cast numérique tolérant (équivalent de pd.to_numeric(errors="coerce")) :
+    textes non numériques, puis pour une cible entière valeurs non entières
+    ou hors bornes, masqués en NULL ; le cast final est sûr (safe=True).
+    """
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        ok = pc.match_substring_regex(arr, _NUMERIC_RE)
+        arr = pc.if_else(ok, pc.utf8_trim_whitespace(arr),
+                         pa.scalar(None, arr.type))
+        arr = pc.cast(arr, pa.float64())
+    if pa.types.is_integer(typ) and pa.types.is_floating(arr.type):
+        info = np.iinfo(typ.to_pandas_dtype())
+        ok = pc.and_(pc.equal(pc.floor(arr), arr),
+                     pc.and_(pc.greater_equal(arr, float(info.min)),
+                             pc.less(arr, float(info.max))))
+        arr = pc.if_else(ok, arr, pa.scalar(None, arr.type))
+    return pc.cast(arr, typ)
+
+
+def _annee_to_int(arr: pa.ChunkedArray) -> pa.ChunkedArray:
+    """
+    'annee' -> int64 quel que soit le type source (date, texte, numérique) ;
+    valeur illisible -> NULL.
+    """
+    if pa.types.is_date(arr.type) or pa.types.is_timestamp(arr.type):
+        return pc.cast(pc.year(arr), pa.int64())
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        # trim avant découpe : " 2022" → "2022" (et non "202")
+        arr = pc.utf8_slice_codeunits(pc.utf8_trim_whitespace(arr), 0, 4)
+    return _to_numeric(arr, pa.int64())
 
 
-def upsert_to_staging(df: pd.DataFrame, year: int):
+def prepare_table(table: pa.Table, year: int) -> pa.Table:
     """
-    COPY dans table temporaire -> UPSERT vers "pro_sante".stg_pro_sante_raw
+    Préparation vectorisée en Arrow (pyarrow.compute, aucun passage pandas) :
+    colonnes manquantes ajoutées en NULL typé, numériques illisibles mis à
+    NULL, puis projection/cast en une passe sur EXPECTED_SCHEMA.
+    """
+    for name, typ in zip(EXPECTED_SCHEMA.names, EXPECTED_SCHEMA.types):
+        if name not in table.column_names:
+            table = table.append_column(name, pa.nulls(table.num_rows, type=typ))
+    table = table.select(EXPECTED_SCHEMA.names)
+    table = table.set_column(0, "annee", _annee_to_int(table["annee"]))
+    for name in ("effectif", "densite"):
+        i = EXPECTED_SCHEMA.get_field_index(name)
+        table = table.set_column(i, name, _to_numeric(
+            table[name], EXPECTED_SCHEMA.field(name).type))
+    table = table.cast(EXPECTED_SCHEMA, safe=False)
+
+    # Filet de sécurité (filtre déjà poussé à la lecture)
+    return table.filter(pc.field("annee") == year)
+
+
+def upsert_to_staging(batches: Iterable[pa.Table], year: int):
+    """
+    COPY BINARY (Arrow, streamé batch par batch) dans table temporaire
+    -> UPSERT vers "pro_sante".stg_pro_sante_raw par lots de UPSERT_BATCH
+    lignes (une transaction par lot)
     """
-    if df.empty:
-        print(
-            f"[WARN] Aucune ligne pour l’année {year}. Abandon du chargement.")
-        return
-
     with psycopg2.connect(**PG_CONN) as conn:
         with conn.cursor() as cur:
+            # Réglages de session (le chargement couvre plusieurs transactions)
             cur.execute("""
-                CREATE TEMP TABLE tmp_stg
-                (LIKE "pro_sante".stg_pro_sante_raw INCLUDING DEFAULTS)
-                ON COMMIT DROP;
+                SET synchronous_commit = off;
+                SET work_mem = '256MB';
+                SET maintenance_work_mem = '512MB';
             """)
-        # TSV sans en-têtes
-        buf = StringIO()
-        df.to_csv(buf, index=False, header=False, sep="\t", na_rep="")
-        buf.seek(0)
+            try:
+                # Types de tmp_stg (COPY binaire : encodage exact requis),
+                # densite alignée sur la colonne de la staging
+                col_types = staging_col_types(cur)
+                cur.execute(temp_table_ddl("tmp_stg", col_types,
+                                           on_commit="PRESERVE ROWS"))
+                cur.execute("""
+                    ALTER TABLE tmp_stg
+                      ADD COLUMN rn bigint GENERATED ALWAYS AS IDENTITY;
+                """)
+                # tmp_stg créée dans la même transaction → FREEZE possible
+                n = copy_batches_binary(cur, batches, "tmp_stg", col_types,
+                                        freeze=True)
+                print(f"[INFO] Après préparation: {n:,} lignes pour l’année {year}")
+                if n == 0:
+                    print(
+                        f"[WARN] Aucune ligne pour l’année {year}. Abandon du chargement.")
+                    return
+                cur.execute("CREATE INDEX ON tmp_stg (rn); ANALYZE tmp_stg;")
+                conn.commit()
+
+                for lo in range(0, n, UPSERT_BATCH):
+                    cur.execute(STAGING_UPSERT_SQL, (year, lo, lo + UPSERT_BATCH))
+                    conn.commit()
+            finally:
+                conn.rollback()
+                cur.execute("""
+                    DROP TABLE IF EXISTS tmp_stg;
+                    RESET synchronous_commit;
+                    RESET work_mem;
+                    RESET maintenance_work_mem;
+                """)
+                conn.commit()
+        print(f"[OK] UPSERT staging terminé pour {year}")
 
+        # VACUUM hors transaction (visibility map + statistiques)
+        conn.autocommit = True
         with conn.cursor() as cur:
-            cur.copy_from(buf, "tmp_stg", sep="\t", null="")
-            cur.execute("""
-                INSERT INTO "pro_sante".stg_pro_sante_raw (
-                  annee, profession_sante, region, libelle_region,
-                  departement, libelle_departement,
-                  classe_age, libelle_classe_age, libelle_sexe,
-                  effectif, densite,
-                  vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
-                )
-                SELECT
-                  annee, profession_sante, region, libelle_region,
-                  departement, libelle_departement,
-                  classe_age, libelle_classe_age, libelle_sexe,
-                  effectif, densite,
-                  vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
-                FROM tmp_stg
-                WHERE annee = %s
-                ON CONFLICT (annee, region, departement, profession_sante, classe_age, libelle_sexe)
-                DO UPDATE SET
-                  effectif = EXCLUDED.effectif,
-                  densite  = EXCLUDED.densite;
-            """, (year,))
-        print(f"[OK] UPSERT staging terminé pour {year}")
+            cur.execute('VACUUM ANALYZE "pro_sante".stg_pro_sante_raw;')
 
 
 def main():
-    df = fetch_parquet_df(AMELI_URL)
+    # Pipeline streamé : lecture → (copie locale) → préparation → COPY,
+    # un record batch à la fois
+    batches = fetch_parquet_batches(AMELI_URL, YEAR)
     if SAVE_LOCAL:
-        try:
-            DROP_DIR.mkdir(parents=True, exist_ok=True)
-            df.to_parquet(OUT_FILE, engine="pyarrow", index=False)
-            print(f"[INFO] Copie locale écrite → {OUT_FILE}")
-        except Exception as e:
-            print(f"[WARN] Impossible d’écrire la copie locale: {e}")
-
-    df_ready = prepare_dataframe(df, YEAR)
-    upsert_to_staging(df_ready, YEAR)
+        batches = _save_local(batches, OUT_FILE)
+
+    ready = (prepare_table(pa.Table.from_batches([b]), YEAR)
+             for b in batches)
+    upsert_to_staging(ready, YEAR)
     print("[DONE] Téléchargement direct + staging OK.")
 
 
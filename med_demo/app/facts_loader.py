@@ -7,7 +7,9 @@ import psycopg2
 from typing import Optional
 
 from datetime import date
+from dims_loader import ensure_dep_code_map
 from ops_logger import log_volume
+from pg_utils import prepare
 
 # ==== LOGGING ====
 log = logging.getLogger("facts_loader")
@@ -23,92 +25,168 @@ PG_CONN = {
 if not PG_CONN["password"]:
     raise RuntimeError("PGPASSWORD manquant (env/Secrets).")
 
+# Chargements multi-années concurrents : échec rapide plutôt qu'attente
+# indéfinie sur un verrou tenu par un autre run
+LOCK_TIMEOUT = os.getenv("FACTS_LOCK_TIMEOUT", "5s")
+
+FACTS_TABLE = '"pro_sante".table_faits_pro_v2'
+
 
 def _exec_sql(conn, sql: str, params: tuple, label: str) -> int:
     with conn.cursor() as cur:
         log.info("SQL → %s", label)
         cur.execute(sql, params)
-        # rowcount sur INSERT..ON CONFLICT peut être -1 selon drivers,
-        # on journalise quand même.
-        try:
-            log.info("→ %s lignes affectées", cur.rowcount)
-        except Exception:
-            pass
-    return 0
+        # rowcount sur INSERT..ON CONFLICT peut être -1 selon drivers :
+        # si la requête renvoie un compte (RETURNING agrégé), on le privilégie.
+        rows = cur.fetchone()[0] if cur.description else cur.rowcount
+        log.info("→ %s lignes affectées", rows)
+    return rows
+
+
+# Lignes valides de staging dont le code département n'a pas d'entrée
+# dans dep_code_map (code non numérique hors 2A/2B) : écartées par la
+# jointure des faits
+_UNMAPPED_DEP_SQL = """
+    SELECT count(*), array_agg(DISTINCT s.departement ORDER BY s.departement)
+    FROM "pro_sante".stg_pro_sante_raw s
+    WHERE s.region <> '99'
+      AND s.departement <> '999'
+      AND s.libelle_sexe IN ('hommes','femmes')
+      AND s.classe_age <> 'tout_age'
+      {year_filter}
+      AND NOT EXISTS (SELECT 1 FROM "pro_sante".dep_code_map m
+                      WHERE m.code = s.departement)
+"""
+
+
+# Table des faits partitionnée (PARTITION BY LIST (id_annee)) : chaque
+# année a sa partition, les upserts concurrents de deux années ne se
+# disputent ni les pages d'index ni les verrous de lignes.
+_IS_PARTITIONED_SQL = """
+    SELECT EXISTS (
+      SELECT 1 FROM pg_partitioned_table
+      WHERE partrelid = '"pro_sante".table_faits_pro_v2'::regclass
+    )
+"""
+
+
+def _year_partition(conn, year: int) -> str:
+    """
+    Partition de l'année (créée si absente) : "pro_sante".faits_<year>,
+    FOR VALUES IN (id_annee de l'année).
+    """
+    child = f'"pro_sante".faits_{year}'
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (child,))
+        if cur.fetchone()[0] is None:
+            cur.execute('SELECT id_annee FROM "pro_sante".annees WHERE annee = %s',
+                        (year,))
+            row = cur.fetchone()
+            if row is None:
+                raise RuntimeError(f"Année {year} absente de pro_sante.annees "
+                                   "(dimensions non peuplées ?)")
+            log.info("Création partition %s (id_annee=%s)", child, row[0])
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {child} "
+                        f"PARTITION OF {FACTS_TABLE} FOR VALUES IN (%s)",
+                        (row[0],))
+    return child
+
+
+# Requête à plat (sans CTE de lecture) : le planner peut pousser le filtre
+# année sous les jointures de dimensions. Le RETURNING agrégé donne le
+# volume écrit sans seconde requête. {year_filter} : vide, ou
+# "AND s.annee = $1" pour la variante paramétrée par année.
+# {target} : table des faits, ou directement la partition de l'année
+# (pas de routage de partition à l'insertion). densite sans cast explicite :
+# conversion d'affectation vers le type de la colonne cible (real ou
+# double precision selon migrate_densite_real), sans passage par float4.
+_FACTS_SQL = """
+    WITH ins AS (
+      INSERT INTO {target}
+        (id_annee, id_profession, id_region, id_departement, id_tranche, id_genre, effectif, densite)
+      SELECT
+        a.id_annee,
+        p.id_profession,
+        r.id_region,
+        d.id_departement,
+        t.id_tranche,
+        g.id_genre,
+        s.effectif::int                AS effectif,
+        s.densite                      AS densite
+      FROM "pro_sante".stg_pro_sante_raw s
+      JOIN "pro_sante".annees      a ON a.annee          = s.annee
+      JOIN "pro_sante".professions p ON p.profession     = s.profession_sante
+      JOIN "pro_sante".regions     r ON r.libelle_region = s.libelle_region
+      /* Code département → id (Corse 2A/2B → 101/102) via dep_code_map */
+      JOIN "pro_sante".dep_code_map m ON m.code = s.departement
+      JOIN "pro_sante".departements d ON d.id_departement = m.id_departement
+      JOIN "pro_sante".tranches_age t ON t.classe_age    = s.classe_age
+      JOIN "pro_sante".genres       g ON g.libelle_sexe  = s.libelle_sexe
+      WHERE s.region <> '99'
+        AND s.departement <> '999'
+        AND s.libelle_sexe IN ('hommes','femmes')
+        AND s.classe_age <> 'tout_age'
+        {year_filter}
+      ON CONFLICT (id_annee, id_profession, id_region, id_departement, id_tranche, id_genre)
+      DO UPDATE SET
+        effectif = EXCLUDED.effectif,
+        densite  = EXCLUDED.densite
+      RETURNING 1
+    )
+    SELECT count(*) FROM ins
+"""
 
 
-def load_facts(year: Optional[int]) -> None:
+def load_facts(conn, year: Optional[int]) -> None:
     """
     Alimente "pro_sante".table_faits_pro_v2 à partir de la staging.
     Si year est None → charge toutes les années présentes en staging.
-    Requiert les dimensions déjà peuplées.
+    Requiert les dimensions déjà peuplées (pro_sante.dep_code_map est
+    créée au besoin).
+    La connexion est fournie par l'appelant (pipeline_runner ou main).
     """
-    year_filter = "AND annee = %s" if year is not None else ""
-    params = (year,) if year is not None else tuple()
+    # lock_timeout (local à la transaction) posé avant toute prise de verrou :
+    # dep_code_map et CREATE TABLE ... PARTITION OF compris
+    with conn.cursor() as cur:
+        cur.execute("SELECT set_config('lock_timeout', %s, true)",
+                    (LOCK_TIMEOUT,))
 
-    sql = f"""
-        WITH s AS (
-          SELECT *
-          FROM "pro_sante".stg_pro_sante_raw
-          WHERE region <> '99'
-            AND departement <> '999'
-            AND libelle_sexe IN ('hommes','femmes')
-            AND classe_age <> 'tout_age'
-            {year_filter}
-        ),
-        j AS (
-          SELECT
-            a.id_annee,
-            p.id_profession,
-            r.id_region,
-            /* Mapping Corse 2A/2B → 101/102 avant jointure */
-            d.id_departement,
-            t.id_tranche,
-            g.id_genre,
-            s.effectif::int                AS effectif,
-            s.densite::double precision    AS densite
-          FROM (
-            SELECT
-              s.*,
-              CASE
-                WHEN s.departement = '2A' THEN 101
-                WHEN s.departement = '2B' THEN 102
-                ELSE NULLIF(s.departement, '')::int
-              END AS dep_norm
-            FROM s
-          ) s
-          JOIN "pro_sante".annees      a ON a.annee          = s.annee
-          JOIN "pro_sante".professions p ON p.profession     = s.profession_sante
-          JOIN "pro_sante".regions     r ON r.libelle_region = s.libelle_region
-          JOIN "pro_sante".departements d ON d.id_departement = s.dep_norm
-          JOIN "pro_sante".tranches_age t ON t.classe_age    = s.classe_age
-          JOIN "pro_sante".genres       g ON g.libelle_sexe  = s.libelle_sexe
-        )
-        INSERT INTO "pro_sante".table_faits_pro_v2
-          (id_annee, id_profession, id_region, id_departement, id_tranche, id_genre, effectif, densite)
-        SELECT
-          id_annee, id_profession, id_region, id_departement, id_tranche, id_genre, effectif, densite
-        FROM j
-        ON CONFLICT (id_annee, id_profession, id_region, id_departement, id_tranche, id_genre)
-        DO UPDATE SET
-          effectif = EXCLUDED.effectif,
-          densite  = EXCLUDED.densite;
-    """
+    # dep_code_map absente si les dimensions ont été sautées (--skip-dims)
+    ensure_dep_code_map(conn)
+    with conn.cursor() as cur:
+        cur.execute(_UNMAPPED_DEP_SQL.format(
+            year_filter="AND s.annee = %s" if year is not None else ""),
+            (year,) if year is not None else ())
+        unmapped, codes = cur.fetchone()
+    if unmapped:
+        log.warning("%s lignes de staging sans correspondance dans "
+                    "dep_code_map (départements %s) → ignorées",
+                    f"{unmapped:,}", ", ".join(codes))
+
+    target = FACTS_TABLE
+    with conn.cursor() as cur:
+        cur.execute(_IS_PARTITIONED_SQL)
+        partitioned = cur.fetchone()[0]
+    if partitioned and year is not None:
+        target = _year_partition(conn, year)
 
-    with psycopg2.connect(**PG_CONN) as conn:
-        _exec_sql(conn, sql, params, "FACTS upsert")
-        conn.commit()
-        log.info("[OK] Faits chargés%s", f" pour {year}" if year else "")
-        # Compte des lignes de faits pour l'année y
+    params = (year,) if year is not None else tuple()
+    if year is None:
+        name = "facts_upsert_all"
+    else:
+        name = f"facts_upsert_{year}" if partitioned else "facts_upsert"
+    prepare(conn, name, _FACTS_SQL.format(
+        target=target,
+        year_filter="AND s.annee = $1" if year is not None else ""))
+
+    cnt_faits = _exec_sql(
+        conn, f"EXECUTE {name}" + ("(%s)" if year is not None else ""),
+        params, f"FACTS upsert → {target}")
+    conn.commit()
+    log.info("[OK] Faits chargés%s", f" pour {year}" if year else "")
+
+    # Volume annuel = lignes upsertées pour l'année y
     if year is not None:
-        with psycopg2.connect(**PG_CONN) as conn, conn.cursor() as cur:
-            cur.execute("""
-                SELECT COUNT(*)
-                FROM "pro_sante".table_faits_pro_v2 f
-                WHERE f.id_annee = (SELECT id_annee FROM "pro_sante".annees WHERE annee = %s)
-            """, (year,))
-            (cnt_faits,) = cur.fetchone()
-
         log_volume(
             pipeline="pro_sante",
             entity="table_faits_pro_v2",
@@ -123,7 +201,7 @@ def load_facts(year: Optional[int]) -> None:
 # ==== MAIN ====
 
 
-def main(year: Optional[int] = None):
+def main(year: Optional[int] = None, conn=None):
     """
     Point d'entrée. Résout l'année au runtime :
     - priorité à l'argument,
@@ -132,7 +210,11 @@ def main(year: Optional[int] = None):
     """
     y_env = os.getenv("YEAR")
     y = year if year is not None else (int(y_env) if y_env else None)
-    load_facts(y)
+    if conn is not None:
+        load_facts(conn, y)
+        return
+    with psycopg2.connect(**PG_CONN) as conn:
+        load_facts(conn, y)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+migrate_densite_real.py
+Migration ponctuelle : densite double precision → real (4 octets,
+1-2 décimales utiles) sur la staging et la table des faits.
+
+- À lancer une fois, hors chargement : l'ALTER réécrit la table sous
+  verrou ACCESS EXCLUSIVE
+- Idempotent : une colonne déjà en real est ignorée
+- Les vues qui lisent densite sont supprimées puis recréées à l'identique
+  dans la même transaction (droits et commentaires des vues à reporter
+  manuellement le cas échéant)
+"""
+
+import os
+import logging
+
+import psycopg2
+
+# ==== LOGGING ====
+log = logging.getLogger("migrate_densite_real")
+
+# ==== CONFIG CONNEXION ====
+PG_CONN = {
+    "host": os.getenv("PGHOST", "localhost"),
+    "port": int(os.getenv("PGPORT", "5432")),
+    "dbname": os.getenv("PGDATABASE", "Health_Professional"),
+    "user": os.getenv("PGUSER", "postgres"),
+    "password": os.getenv("PGPASSWORD"),  # pas de défaut
+}
+if not PG_CONN["password"]:
+    raise RuntimeError("PGPASSWORD manquant (env/Secrets).")
+
+TABLES = ("stg_pro_sante_raw", "table_faits_pro_v2")
+
+_COLUMN_TYPE_SQL = """
+    SELECT data_type
+    FROM information_schema.columns
+    WHERE table_schema = 'pro_sante'
+      AND table_name   = %s
+      AND column_name  = 'densite'
+"""
+
+# Vues dépendant de la colonne densite (pg_depend → règle de la vue)
+_DEPENDENT_VIEWS_SQL = """
+    SELECT DISTINCT v.oid::regclass::text, pg_get_viewdef(v.oid)
+    FROM pg_depend d
+    JOIN pg_rewrite w ON w.oid = d.objid
+    JOIN pg_class v ON v.oid = w.ev_class
+    JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+    WHERE d.classid = 'pg_rewrite'::regclass
+      AND d.refobjid = %s::regclass
+      AND a.attname = 'densite'
+      AND v.oid <> d.refobjid
+"""
+
+
+def migrate(conn) -> None:
+    """
+    ALTER COLUMN densite TYPE real sur chaque table de TABLES encore en
+    double precision, vues dépendantes recréées. Une transaction par table.
+    """
+    with conn.cursor() as cur:
+        for table in TABLES:
+            cur.execute(_COLUMN_TYPE_SQL, (table,))
+            row = cur.fetchone()
+            if row is None or row[0] == "real":
+                log.info("%s.densite : %s → skip", table,
+                         "absente" if row is None else "déjà real")
+                continue
+
+            qualified = f'"pro_sante".{table}'
+            cur.execute(_DEPENDENT_VIEWS_SQL, (qualified,))
+            views = cur.fetchall()
+            for name, _ in views:
+                log.info("DROP VIEW %s (recréée après l'ALTER)", name)
+                cur.execute(f"DROP VIEW {name};")
+
+            log.info("ALTER %s.densite %s → real…", table, row[0])
+            cur.execute(f"ALTER TABLE {qualified} "
+                        "ALTER COLUMN densite TYPE real USING densite::real;")
+
+            for name, definition in views:
+                cur.execute(f"CREATE VIEW {name} AS {definition}")
+            conn.commit()
+            log.info("[OK] %s.densite en real", table)
+
+
+def main():
+    with psycopg2.connect(**PG_CONN) as conn:
+        migrate(conn)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=getattr(logging, os.getenv(
+            "LOG_LEVEL", "INFO").upper(), logging.INFO),
+        format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
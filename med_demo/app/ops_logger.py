@@ -1,22 +1,27 @@
 # ops_logger.py
-import os
 import uuid
 import json
+from contextlib import contextmanager
 from datetime import datetime, timezone
 import psycopg2
+import psycopg2.extras as extras
 
+from pg_utils import LazyPool, dsn_from_env
 
+# Pool partagé (créé à la première écriture de log ; PGPASSWORD vérifié
+# à ce moment-là, pas à l'import)
+_get_pool = LazyPool(4, dsn_from_env)
+
+
+@contextmanager
 def _conn():
-    pwd = os.getenv("PGPASSWORD")
-    if not pwd:
-        raise RuntimeError("PGPASSWORD manquant (env/Secrets).")
-    return psycopg2.connect(
-        host=os.getenv("PGHOST", "localhost"),
-        port=int(os.getenv("PGPORT", "5432")),
-        dbname=os.getenv("PGDATABASE", "Health_Professional"),
-        user=os.getenv("PGUSER", "postgres"),
-        password=pwd,
-    )
+    pool = _get_pool()
+    cn = pool.getconn()
+    try:
+        with cn:  # commit / rollback
+            yield cn
+    finally:
+        pool.putconn(cn)
 
 
 def log_run(pipeline, component, started_at, finished_at, status,
@@ -32,6 +37,31 @@ def log_run(pipeline, component, started_at, finished_at, status,
               status, rows_written, message, json.dumps(extra or {})))
 
 
+def log_runs_bulk(records, page_size=1000):
+    """
+    Insère plusieurs runs en un aller-retour par page (execute_values).
+    records : itérable de dicts avec les arguments de log_run.
+    """
+    rows = []
+    for r in records:
+        rows.append((
+            str(uuid.uuid4()), r["pipeline"], r["component"],
+            r["started_at"], r["finished_at"],
+            (r["finished_at"] - r["started_at"]).total_seconds(),
+            r["status"], r.get("rows_written"), r.get("message"),
+            json.dumps(r.get("extra") or {}),
+        ))
+    if not rows:
+        return 0
+    with _conn() as cn, cn.cursor() as cur:
+        extras.execute_values(cur, """
+            INSERT INTO ops.run_log(run_id, pipeline, component, started_at, finished_at,
+                                    duration_s, status, rows_written, message, extra)
+            VALUES %s
+        """, rows, page_size=page_size)
+    return len(rows)
+
+
 def log_volume(pipeline, entity, as_of_date, volume,
                expected_min=None, expected_max=None, agg_window='Y', extra=None):
     with _conn() as cn, cn.cursor() as cur:
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+parquet_http.py
+Lecture de Parquet distant (HTTP) par requêtes Range parallèles.
+
+- Footer lu via une requête "Range: bytes=-65536"
+- Plages des column chunks utiles calculées depuis les métadonnées,
+  fusionnées lorsqu'elles sont séparées de moins de 1 Mio ; row groups
+  exclus par les statistiques min/max de l'année ignorés
+- GET concurrents (ThreadPoolExecutor), assemblés en mémoire ; chaque
+  thread garde sa connexion HTTP ouverte (keep-alive, pas de handshake
+  TCP/TLS par plage)
+- Fallback : si le serveur ignore Range, le fichier complet est utilisé
+"""
+
+import bisect
+import http.client
+import io
+import os
+import re
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# ========= PARAMS =========
+FOOTER_PROBE = 64 * 1024          # octets lus en fin de fichier
+COALESCE_GAP = 1024 * 1024        # fusion des plages proches (1 Mio)
+MAX_WORKERS = int(os.getenv("PARQUET_HTTP_WORKERS", "16"))  # GET concurrents
+HTTP_TIMEOUT = 60                 # secondes
+
+# Pool d'I/O Arrow (lectures locales / datasets), si précisé
+if os.getenv("ARROW_IO_THREADS"):
+    pa.set_io_thread_count(int(os.getenv("ARROW_IO_THREADS")))
+
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+# ========= HTTP =========
+_local = threading.local()
+
+
+def _probe(url: str) -> Tuple[int, http.client.HTTPMessage, bytes, str]:
+    """
+    GET "Range: bytes=-FOOTER_PROBE" (redirections suivies par urllib).
+    Retourne aussi l'URL finale, utilisée ensuite pour les plages.
+    Les en-têtes restent un HTTPMessage (recherche insensible à la casse).
+    """
+    req = urllib.request.Request(url, headers={"Range": f"bytes=-{FOOTER_PROBE}"})
+    with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+        return resp.status, resp.headers, resp.read(), resp.geturl()
+
+
+def _connection(parts: urllib.parse.SplitResult,
+                fresh: bool = False) -> http.client.HTTPConnection:
+    """
+    Connexion keep-alive du thread courant pour (schéma, hôte).
+    """
+    conns = _local.__dict__.setdefault("conns", {})
+    key = (parts.scheme, parts.netloc)
+    cn = conns.get(key)
+    if cn is None or fresh:
+        if cn is not None:
+            cn.close()
+        cls = (http.client.HTTPSConnection if parts.scheme == "https"
+               else http.client.HTTPConnection)
+        cn = conns[key] = cls(parts.netloc, timeout=HTTP_TIMEOUT)
+    return cn
+
+
+def _get_range(url: str, start: int, end: int) -> bytes:
+    """
+    GET Range [start, end] (inclusif) sur la connexion keep-alive du thread.
+    Une reconnexion est tentée si le serveur a fermé la connexion.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    headers = {"Range": f"bytes={start}-{end}"}
+    for attempt in (0, 1):
+        cn = _connection(parts, fresh=attempt > 0)
+        try:
+            cn.request("GET", path, headers=headers)
+            resp = cn.getresponse()
+            body = resp.read()
+            break
+        except (http.client.HTTPException, ConnectionError):
+            if attempt:
+                raise
+    if resp.status != 206:
+        raise IOError(f"GET Range {start}-{end} → HTTP {resp.status} ({url})")
+    return body
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Fichier en lecture seule reconstitué à partir de plages d'octets.
+    Une lecture hors des plages déjà rapatriées déclenche un GET Range.
+    """
+
+    def __init__(self, url: str, size: int, chunks: Dict[int, bytes]):
+        self.url = url
+        self.size = size
+        self._starts: List[int] = []
+        self._chunks: List[bytes] = []
+        self._pos = 0
+        for start, data in chunks.items():
+            self.add(start, data)
+
+    def add(self, start: int, data: bytes) -> None:
+        i = bisect.bisect_left(self._starts, start)
+        self._starts.insert(i, start)
+        self._chunks.insert(i, data)
+
+    def _lookup(self, start: int, n: int) -> Optional[memoryview]:
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i >= 0:
+            off = start - self._starts[i]
+            data = self._chunks[i]
+            if off + n <= len(data):
+                return memoryview(data)[off:off + n]
+        return None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+        view = self._lookup(self._pos, n)
+        if view is None:
+            data = _get_range(self.url, self._pos, self._pos + n - 1)
+            self.add(self._pos, data)
+            view = memoryview(data)[:n]
+        b[:n] = view
+        self._pos += n
+        return n
+
+
+# ========= PLAGES =========
+def _may_contain_year(rg: pq.RowGroupMetaData, year: int, column: str) -> bool:
+    """
+    False si les statistiques min/max de 'column' excluent l'année
+    (entier, date/timestamp, texte "AAAA…") ; True sinon ou sans statistiques.
+    """
+    for j in range(rg.num_columns):
+        col = rg.column(j)
+        if col.path_in_schema != column:
+            continue
+        stats = col.statistics
+        if stats is None or not stats.has_min_max:
+            return True
+        lo, hi = stats.min, stats.max
+        if isinstance(lo, (date, datetime)):
+            lo, hi = lo.year, hi.year
+        elif isinstance(lo, (str, bytes)):
+            if isinstance(lo, bytes):
+                lo, hi = lo.decode("utf-8", "replace"), hi.decode("utf-8", "replace")
+            key = str(year)
+            return lo[:len(key)] <= key <= hi[:len(key)]
+        try:
+            return lo <= year <= hi
+        except TypeError:
+            return True
+    return True
+
+
+def get_byte_ranges(metadata: pq.FileMetaData,
+                    columns: Optional[Iterable[str]] = None,
+                    gap: int = COALESCE_GAP,
+                    year: Optional[int] = None,
+                    year_column: str = "annee") -> List[Tuple[int, int]]:
+    """
+    Plages [début, fin) des column chunks demandés, fusionnées si l'écart
+    entre deux plages est inférieur à 'gap'. Avec 'year', les row groups
+    dont les statistiques de 'year_column' excluent l'année sont ignorés.
+    """
+    wanted = set(columns) if columns is not None else None
+    ranges = []
+    for i in range(metadata.num_row_groups):
+        rg = metadata.row_group(i)
+        if year is not None and not _may_contain_year(rg, year, year_column):
+            continue
+        for j in range(rg.num_columns):
+            col = rg.column(j)
+            if wanted is not None and col.path_in_schema.split(".")[0] not in wanted:
+                continue
+            offsets = [o for o in (col.dictionary_page_offset,
+                                   col.data_page_offset) if o]
+            start = min(offsets)
+            ranges.append((start, start + col.total_compressed_size))
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] < gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# ========= LECTURE =========
+def open_parquet_url(url: str, columns: Optional[Iterable[str]] = None,
+                     max_workers: int = MAX_WORKERS,
+                     year: Optional[int] = None) -> ds.ParquetFileFragment:
+    """
+    Ouvre un Parquet distant en ne rapatriant que le footer et les column
+    chunks des colonnes demandées (GET Range concurrents), limités aux row
+    groups pouvant contenir 'year' si précisé.
+    Retourne un fragment pyarrow prêt pour .to_table(columns=..., filter=...).
+    """
+    status, headers, tail, url = _probe(url)
+    if status != 206:
+        # Serveur sans support Range : le corps contient tout le fichier
+        return ds.ParquetFileFormat().make_fragment(
+            pa.BufferReader(pa.py_buffer(tail)))
+    content_range = headers.get("Content-Range", "")
+    m = _CONTENT_RANGE.match(content_range)
+    if m is None:
+        # 206 sans taille exploitable : le corps n'est que la fin du fichier
+        raise IOError(f"HTTP 206 sans Content-Range exploitable "
+                      f"({content_range!r}, {url})")
+
+    size = int(m.group(3))
+    f = RangeFile(url, size, {size - len(tail): tail})
+    metadata = pq.ParquetFile(f).metadata
+
+    ranges = get_byte_ranges(metadata, columns, year=year)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        bodies = ex.map(lambda r: _get_range(url, r[0], r[1] - 1), ranges)
+        for (start, _), body in zip(ranges, bodies):
+            f.add(start, body)
+
+    f.seek(0)
+    return ds.ParquetFileFormat().make_fragment(f)
+
+
+def year_filter(schema: pa.Schema, year: int,
+                column: str = "annee") -> Optional[ds.Expression]:
+    """
+    Prédicat Arrow sur la colonne année adapté à son type physique
+    (entier, date/timestamp, texte), pour que le lecteur Parquet élague
+    les row groups via les statistiques min/max.
+    """
+    if column not in schema.names:
+        return None
+    typ = schema.field(column).type
+    field = ds.field(column)
+    if pa.types.is_date(typ) or pa.types.is_timestamp(typ):
+        lo = pa.scalar(date(year, 1, 1)).cast(typ)
+        hi = pa.scalar(date(year + 1, 1, 1)).cast(typ)
+        return (field >= lo) & (field < hi)
+    if pa.types.is_string(typ) or pa.types.is_large_string(typ):
+        return pc.starts_with(field, str(year))
+    return field == year
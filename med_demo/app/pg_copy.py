@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+pg_copy.py
+COPY binaire Postgres alimenté directement depuis une table Arrow.
+
+- Pas de sérialisation texte (to_csv) ni de parsing côté serveur
+- Les colonnes Arrow sont castées vers le type Postgres déclaré
+- Encodage vectorisé NumPy (tableaux structurés big-endian pour les
+  types fixes, buffers Arrow pour le texte), sans boucle par cellule
+- Encodage par record batch, streamé vers copy_expert (pas de copie
+  pandas intermédiaire ni de buffer COPY complet)
+"""
+
+import io
+import struct
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# ========= FORMAT BINAIRE =========
+# En-tête : signature + flags (0) + longueur d'extension (0)
+_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_TRAILER = struct.pack("!h", -1)
+
+COPY_BATCH_ROWS = 50_000          # lignes encodées à la fois
+COPY_BLOCK_SIZE = 1024 * 1024     # taille des lectures de copy_expert
+
+# Type Postgres -> (type Arrow cible, dtype NumPy big-endian ou None si texte)
+PG_TYPES = {
+    "smallint": (pa.int16(), np.dtype(">i2")),
+    "integer": (pa.int32(), np.dtype(">i4")),
+    "bigint": (pa.int64(), np.dtype(">i8")),
+    "real": (pa.float32(), np.dtype(">f4")),
+    "double precision": (pa.float64(), np.dtype(">f8")),
+    "text": (pa.string(), None),
+}
+
+_WORD = np.arange(4)
+
+
+def _column_parts(arr: pa.Array, pg_type: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Champs binaires d'une colonne, sans boucle Python par cellule :
+    (octets de chaque champ "longueur + valeur" concaténés, taille de chaque
+    champ). Longueur -1 et aucune valeur pour NULL.
+    """
+    valid = ~arr.is_null().to_numpy(zero_copy_only=False)
+    dtype = PG_TYPES[pg_type][1]
+    if dtype is not None:
+        # Tableau structuré (longueur, valeur) entrelacé, NULL retirés ensuite
+        rec = np.empty(len(arr), dtype=[("len", ">i4"), ("v", dtype)])
+        rec["len"] = np.where(valid, dtype.itemsize, -1)
+        rec["v"] = arr.fill_null(0).to_numpy(zero_copy_only=False)
+        raw = rec.view(np.uint8).reshape(len(arr), rec.itemsize)
+        if valid.all():
+            return raw.ravel(), np.full(len(arr), rec.itemsize)
+        keep = np.ones(raw.shape, dtype=bool)
+        keep[~valid, 4:] = False
+        return raw[keep], np.where(valid, rec.itemsize, 4)
+
+    # Texte : mot de longueur + octets UTF-8 recopiés depuis le buffer Arrow
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int32,
+                            count=len(arr) + 1, offset=arr.offset * 4)
+    data = arr.buffers()[2]
+    data = (np.frombuffer(data, dtype=np.uint8) if data is not None
+            else np.empty(0, dtype=np.uint8))
+    lens = np.where(valid, np.diff(offsets), 0)
+    sizes = lens + 4
+    starts = np.cumsum(sizes) - sizes
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    words = np.where(valid, lens, -1).astype(">i4").view(np.uint8)
+    out[(starts[:, None] + _WORD).ravel()] = words
+    n = int(lens.sum())
+    if n:
+        rows = np.repeat(np.arange(len(arr)), lens)
+        pos = np.arange(n) - np.repeat(np.cumsum(lens) - lens, lens)
+        out[starts[rows] + 4 + pos] = data[offsets[:-1][rows] + pos]
+    return out, sizes
+
+
+def _encode_batch(table: pa.Table, pg_types: List[str]) -> bytes:
+    """
+    Encode un lot de lignes (nombre de champs + champs de chaque colonne) :
+    les champs de chaque colonne sont dispersés à leur position dans la
+    ligne par indexation NumPy.
+    """
+    nrows = table.num_rows
+    parts = [_column_parts(table.column(i).combine_chunks(), t)
+             for i, t in enumerate(pg_types)]
+    sizes = np.stack([s for _, s in parts]) if parts else np.zeros((0, nrows), int)
+    row_sizes = 2 + sizes.sum(axis=0)
+    pos = np.cumsum(row_sizes) - row_sizes
+
+    out = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+    field_count = np.frombuffer(struct.pack("!h", len(pg_types)), dtype=np.uint8)
+    out[(pos[:, None] + np.arange(2)).ravel()] = np.tile(field_count, nrows)
+    pos = pos + 2
+    for data, size in parts:
+        rows = np.repeat(np.arange(nrows), size)
+        off = np.arange(len(data)) - np.repeat(np.cumsum(size) - size, size)
+        out[pos[rows] + off] = data
+        pos = pos + size
+    return out.tobytes()
+
+
+def align_table(table: pa.Table, col_types: Dict[str, str]) -> pa.Table:
+    """
+    Projette/caste la table sur col_types (ordre strict).
+    Les colonnes absentes deviennent des colonnes NULL typées.
+    """
+    arrays = []
+    for name, pg_type in col_types.items():
+        typ = PG_TYPES[pg_type][0]
+        if name in table.column_names:
+            arrays.append(pc.cast(table[name], typ, safe=False))
+        else:
+            arrays.append(pa.nulls(table.num_rows, type=typ))
+    return pa.Table.from_arrays(arrays, names=list(col_types))
+
+
+class CopyBinaryStream(io.RawIOBase):
+    """
+    Flux COPY BINARY encodé à la demande, record batch par record batch :
+    copy_expert lit le flux par blocs, seul le batch courant est sérialisé
+    en mémoire (pas de buffer intégral).
+    """
+
+    def __init__(self, batches: Iterable, col_types: Dict[str, str]):
+        self.rows = 0
+        self._col_types = col_types
+        self._chunks = self._generate(batches)
+        self._pending = memoryview(b"")
+        self._offset = 0
+
+    def _generate(self, batches: Iterable) -> Iterator[bytes]:
+        pg_types = list(self._col_types.values())
+        yield _HEADER
+        for batch in batches:
+            if isinstance(batch, pa.RecordBatch):
+                batch = pa.Table.from_batches([batch])
+            batch = align_table(batch, self._col_types)
+            self.rows += batch.num_rows
+            yield _encode_batch(batch, pg_types)
+        yield _TRAILER
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        # memoryview + offset : le reste du chunk courant n'est pas recopié
+        while self._offset >= len(self._pending):
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._offset = 0
+        n = min(len(b), len(self._pending) - self._offset)
+        b[:n] = self._pending[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+
+def copy_batches_binary(cur, batches: Iterable, target: str,
+                        col_types: Dict[str, str], freeze: bool = False) -> int:
+    """
+    COPY <target> (cols) FROM STDIN WITH (FORMAT BINARY) depuis un itérable
+    de record batches / tables Arrow, encodés au fil de la lecture.
+    freeze=True : COPY FREEZE (cible créée/TRUNCATE dans la transaction).
+    Retourne le nombre de lignes envoyées.
+    """
+    stream = CopyBinaryStream(batches, col_types)
+    cols = ", ".join(col_types)
+    opts = "FORMAT BINARY, FREEZE TRUE" if freeze else "FORMAT BINARY"
+    cur.copy_expert(
+        f"COPY {target} ({cols}) FROM STDIN WITH ({opts})",
+        stream, size=COPY_BLOCK_SIZE)
+    return stream.rows
+
+
+def copy_table_binary(cur, table: pa.Table, target: str,
+                      col_types: Dict[str, str], freeze: bool = False) -> int:
+    """
+    COPY BINARY d'une table Arrow, streamée par record batch.
+    Retourne le nombre de lignes envoyées.
+    """
+    return copy_batches_binary(
+        cur, table.to_batches(max_chunksize=COPY_BATCH_ROWS), target,
+        col_types, freeze=freeze)
+
+
+def temp_table_ddl(name: str, col_types: Dict[str, str],
+                   on_commit: str = "DROP") -> str:
+    """
+    DDL d'une table temporaire dont les types correspondent exactement
+    à l'encodage binaire (ON COMMIT DROP par défaut, ou PRESERVE ROWS si
+    la table doit survivre à plusieurs transactions).
+    """
+    cols = ",\n  ".join(f"{c} {t}" for c, t in col_types.items())
+    return f"CREATE TEMP TABLE {name} (\n  {cols}\n) ON COMMIT {on_commit};"
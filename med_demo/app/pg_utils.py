@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+pg_utils.py
+Briques Postgres partagées par les loaders.
+
+- Pool de connexions créé à la première demande (thread-safe, fermé à
+  la sortie du process)
+- PREPARE une seule fois par connexion (plan réutilisé par EXECUTE)
+- Colonnes, types et UPSERT par lots de la staging stg_pro_sante_raw
+"""
+
+import os
+import atexit
+import logging
+import threading
+import weakref
+from typing import Callable, Dict, Optional, Union
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+log = logging.getLogger("pg_utils")
+
+
+# ========= CONNEXION =========
+def dsn_from_env() -> str:
+    """
+    DSN depuis les variables PG* (PGPASSWORD obligatoire, pas de défaut).
+    """
+    pwd = os.getenv("PGPASSWORD")
+    if not pwd:
+        raise RuntimeError("PGPASSWORD manquant (env/Secrets).")
+    return psycopg2.extensions.make_dsn(
+        host=os.getenv("PGHOST", "localhost"),
+        port=int(os.getenv("PGPORT", "5432")),
+        dbname=os.getenv("PGDATABASE", "Health_Professional"),
+        user=os.getenv("PGUSER", "postgres"),
+        password=pwd,
+    )
+
+
+class LazyPool:
+    """
+    ThreadedConnectionPool créé au premier appel (double vérification sous
+    verrou), fermé via atexit. dsn : chaîne, ou fonction appelée à la
+    création (erreur de configuration remontée à la première connexion).
+    """
+
+    def __init__(self, maxconn: int, dsn: Union[str, Callable[[], str]],
+                 minconn: int = 1):
+        self._maxconn = maxconn
+        self._minconn = minconn
+        self._dsn = dsn
+        self._pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+        self._lock = threading.Lock()
+
+    def __call__(self) -> psycopg2.pool.ThreadedConnectionPool:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    dsn = self._dsn() if callable(self._dsn) else self._dsn
+                    pool = psycopg2.pool.ThreadedConnectionPool(
+                        self._minconn, self._maxconn, dsn)
+                    atexit.register(pool.closeall)
+                    self._pool = pool
+        return self._pool
+
+
+# ========= REQUETES PREPAREES =========
+# Requêtes préparées par connexion (PREPARE vit avec la session)
+_prepared = weakref.WeakKeyDictionary()
+
+
+def prepare(conn, name: str, sql: str, setup: Optional[str] = None) -> None:
+    """
+    PREPARE <name> AS <sql> une seule fois par connexion : le plan est
+    ensuite réutilisé par EXECUTE. setup : SQL exécuté juste avant (ex.
+    table temporaire dont dépend la requête), dans la transaction courante.
+    """
+    done = _prepared.setdefault(conn, set())
+    if name not in done:
+        with conn.cursor() as cur:
+            if setup:
+                cur.execute(setup)
+            log.debug("PREPARE %s", name)
+            cur.execute(f"PREPARE {name} AS {sql}")
+        done.add(name)
+
+
+# ========= STAGING =========
+# Colonnes attendues par la table de staging (ordre strict)
+STAGING_COLS = [
+    "annee", "profession_sante", "region", "libelle_region",
+    "departement", "libelle_departement",
+    "classe_age", "libelle_classe_age", "libelle_sexe",
+    "effectif", "densite",
+    "vision_generale_all", "vision_generale_prescriptions", "vision_profession_territoire"
+]
+
+# Types de tmp_stg (COPY binaire : encodage exact requis). densite : voir
+# staging_col_types (type réel de la colonne en base)
+STAGING_COL_TYPES = {c: "text" for c in STAGING_COLS}
+STAGING_COL_TYPES.update(annee="integer", effectif="bigint",
+                         densite="double precision")
+
+# Type catalogue d'une colonne (ex. "real", "double precision")
+_COLUMN_TYPE_SQL = """
+    SELECT format_type(atttypid, atttypmod)
+    FROM pg_attribute
+    WHERE attrelid = %s::regclass
+      AND attname = %s
+      AND NOT attisdropped
+"""
+
+
+def column_type(cur, table: str, column: str) -> Optional[str]:
+    """
+    Type SQL de table.column d'après le catalogue (None si absente).
+    """
+    cur.execute(_COLUMN_TYPE_SQL, (table, column))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def staging_col_types(cur) -> Dict[str, str]:
+    """
+    STAGING_COL_TYPES avec densite typée comme la colonne de la staging :
+    real une fois migrate_densite_real passé, double precision sinon (un
+    float4 recopié dans une colonne double precision fausserait les
+    valeurs, ex. 123.45 → 123.44999694824219).
+    """
+    types = dict(STAGING_COL_TYPES)
+    if column_type(cur, '"pro_sante".stg_pro_sante_raw', "densite") == "real":
+        types["densite"] = "real"
+    return types
+
+
+# UPSERT d'un lot de tmp_stg (rn = numéro de ligne attribué au COPY)
+STAGING_UPSERT_SQL = """
+    INSERT INTO "pro_sante".stg_pro_sante_raw (
+      annee, profession_sante, region, libelle_region,
+      departement, libelle_departement,
+      classe_age, libelle_classe_age, libelle_sexe,
+      effectif, densite,
+      vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
+    )
+    SELECT
+      annee, profession_sante, region, libelle_region,
+      departement, libelle_departement,
+      classe_age, libelle_classe_age, libelle_sexe,
+      effectif, densite,
+      vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
+    FROM tmp_stg
+    WHERE annee = %s
+      AND rn > %s AND rn <= %s
+    -- ordre de la clé unique : sondes ON CONFLICT séquentielles
+    ORDER BY annee, region, departement, profession_sante, classe_age, libelle_sexe
+    ON CONFLICT (annee, region, departement, profession_sante, classe_age, libelle_sexe)
+    DO UPDATE SET
+      effectif = EXCLUDED.effectif,
+      densite  = EXCLUDED.densite;
+"""
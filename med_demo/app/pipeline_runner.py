@@ -11,41 +11,61 @@ Caractéristiques :
 - Logs homogènes et durées par étape
 - Tolérant aux signatures main() / main(year)
 - --stop-on-fail pour interrompre en cas d'erreur
+- Une seule connexion Postgres partagée par les trois étapes
 """
 
 import os
 import sys
 import time
+import inspect
 import argparse
 import logging
+import psycopg2
 from types import ModuleType
 from typing import Optional
 from datetime import datetime, timezone
 from ops_logger import log_run
 
+# Les loaders lisent YEAR à l'appel de main() (pas à l'import) :
+# imports au niveau module, payés une seule fois par processus. Une erreur
+# d'import (ex. PGPASSWORD manquant) est journalisée par main().
+try:
+    import staging_loader
+    import dims_loader
+    import facts_loader
+except Exception as e:
+    _IMPORT_ERROR: Optional[Exception] = e
+else:
+    _IMPORT_ERROR = None
+
 
 # ========= LOGGING =========
 def setup_logging(level: str = "INFO") -> logging.Logger:
     lvl = getattr(logging, level.upper(), logging.INFO)
+    # force : remplace une configuration posée à l'import d'un module
     logging.basicConfig(
         level=lvl,
         format="%(asctime)s | %(levelname)-5s | %(name)s | %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
+        force=True,
     )
     return logging.getLogger("pipeline")
 
 
 # ========= HELPERS =========
-def _call_module_main(mod: ModuleType, year: int, logger: logging.Logger) -> None:
+def _call_module_main(mod: ModuleType, year: int, logger: logging.Logger, conn=None) -> None:
     """
-    Appelle mod.main(year) si possible, sinon mod.main()
-    (pour compatibilité avec d'anciens modules).
+    Appelle mod.main(year, conn=conn) si possible, sinon mod.main(year)
+    ou mod.main() (pour compatibilité avec d'anciens modules).
     """
     if not hasattr(mod, "main"):
         raise AttributeError(
             f"Le module {mod.__name__} n'expose pas de fonction main().")
 
     main_fn = getattr(mod, "main")
+    if conn is not None and "conn" in inspect.signature(main_fn).parameters:
+        main_fn(year, conn=conn)
+        return
     try:
         # Essai avec 'year'
         main_fn(year)
@@ -56,18 +76,22 @@ def _call_module_main(mod: ModuleType, year: int, logger: logging.Logger) -> Non
         main_fn()
 
 
-def _run_step(title: str, mod: ModuleType, year: int, logger: logging.Logger, stop_on_fail: bool = False) -> float:
+def _run_step(title: str, mod: ModuleType, year: int, logger: logging.Logger,
+              stop_on_fail: bool = False, conn=None) -> float:
     logger.info("=== Début %s ===", title)
     started = datetime.now(timezone.utc)
     t0 = time.time()
     status = "OK"
     msg = None
     try:
-        _call_module_main(mod, year, logger)
+        _call_module_main(mod, year, logger, conn)
     except Exception as e:
         status = "KO"
         msg = str(e)
         logger.exception("Échec étape %s : %s", title, e)
+        # Transaction en échec : on la purge pour les étapes suivantes
+        if conn is not None:
+            conn.rollback()
         if stop_on_fail:
             finished = datetime.now(timezone.utc)
             raise
@@ -81,8 +105,8 @@ def _run_step(title: str, mod: ModuleType, year: int, logger: logging.Logger, st
     return time.time() - t0
 
 
-# ========= ENTRYPOINT =========
-def main(argv: Optional[list] = None) -> None:
+# ========= CLI =========
+def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Runner du pipeline Ameli → Postgres")
     parser.add_argument("--year", type=int, required=True,
@@ -97,55 +121,57 @@ def main(argv: Optional[list] = None) -> None:
                         help="Sauter l'étape dimensions")
     parser.add_argument("--skip-facts", action="store_true",
                         help="Sauter l'étape faits")
+    return parser
 
-    args = parser.parse_args(argv)
 
-    logger = setup_logging(args.log_level)
+_PARSER = _build_parser()
 
-    # Pose l’ENV YEAR AVANT d’importer les modules (pour compat globale)
-    os.environ["YEAR"] = str(args.year)
 
-    # Imports après paramétrage de l'ENV
-    try:
-        import staging_loader
-    except Exception as e:
-        logger.exception("Impossible d'importer staging_loader : %s", e)
-        sys.exit(1)
+# ========= ENTRYPOINT =========
+def main(argv: Optional[list] = None) -> None:
+    args = _PARSER.parse_args(argv)
 
-    try:
-        import dims_loader
-    except Exception as e:
-        logger.exception("Impossible d'importer dims_loader : %s", e)
+    logger = setup_logging(args.log_level)
+    if _IMPORT_ERROR is not None:
+        logger.error("Impossible d'importer les loaders : %s", _IMPORT_ERROR,
+                     exc_info=_IMPORT_ERROR)
         sys.exit(1)
 
-    try:
-        import facts_loader
-    except Exception as e:
-        logger.exception("Impossible d'importer facts_loader : %s", e)
-        sys.exit(1)
+    # ENV YEAR pour les modules qui ne prennent pas 'year' en argument
+    os.environ["YEAR"] = str(args.year)
 
     logger.info("=== Démarrage pipeline ===")
     total_t0 = time.time()
 
-    # STAGING
-    if not args.skip_staging:
-        _run_step("staging", staging_loader,
-                  args.year, logger, args.stop_on_fail)
-    else:
-        logger.info("=== Étape staging SKIPPED ===")
-
-    # DIMENSIONS
-    if not args.skip_dims:
-        _run_step("dimensions", dims_loader,
-                  args.year, logger, args.stop_on_fail)
-    else:
-        logger.info("=== Étape dimensions SKIPPED ===")
-
-    # FAITS
-    if not args.skip_facts:
-        _run_step("faits", facts_loader, args.year, logger, args.stop_on_fail)
-    else:
-        logger.info("=== Étape faits SKIPPED ===")
+    # Connexion unique partagée par les étapes (une seule session backend)
+    conn = psycopg2.connect(staging_loader.DSN)
+    conn.autocommit = False
+    try:
+        # STAGING
+        if not args.skip_staging:
+            _run_step("staging", staging_loader,
+                      args.year, logger, args.stop_on_fail, conn)
+        else:
+            logger.info("=== Étape staging SKIPPED ===")
+
+        # DIMENSIONS
+        if not args.skip_dims:
+            _run_step("dimensions", dims_loader,
+                      args.year, logger, args.stop_on_fail, conn)
+        else:
+            logger.info("=== Étape dimensions SKIPPED ===")
+
+        # FAITS
+        if not args.skip_facts:
+            _run_step("faits", facts_loader, args.year,
+                      logger, args.stop_on_fail, conn)
+        else:
+            logger.info("=== Étape faits SKIPPED ===")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
     total_dt = time.time() - total_t0
     logger.info("Pipeline terminé sans erreur. (%.1fs)", total_dt)
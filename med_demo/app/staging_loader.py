@@ -16,38 +16,57 @@ from pathlib import Path
 from typing import Optional
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 from ops_logger import log_volume
+from parquet_http import open_parquet_url, year_filter
+from pg_copy import copy_table_binary, temp_table_ddl
+from pg_utils import (LazyPool, STAGING_COLS, STAGING_UPSERT_SQL,
+                      staging_col_types)
 from datetime import date
 
 
 # ========= LOGGING =========
+# Configuration posée par l'appelant (pipeline_runner) ou sous __main__
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
 log = logging.getLogger("ameli_loader")
 
 
 # ========= PARAMS =========
-# sauvegarde locale activée par défaut (brut + CSV préparé)
+# sauvegarde locale activée par défaut (brut Feather + Parquet préparé)
 SAVE_LOCAL = os.getenv("SAVE_LOCAL", "true").lower() in {
     "1", "true", "yes", "y"}
 
+# Rechargement complet : TRUNCATE de la staging (toutes années) puis
+# COPY FREEZE direct, sans table temporaire ni ON CONFLICT
+FULL_RELOAD = os.getenv("FULL_RELOAD", "false").lower() in {
+    "1", "true", "yes", "y"}
+
+# Taille des lots d'UPSERT staging (une transaction par lot)
+UPSERT_BATCH = int(os.getenv("UPSERT_BATCH", "10000"))
+
+# MERGE (PG15+) au lieu de INSERT ON CONFLICT : opt-in, à réserver aux
+# chargements sans écrivain concurrent sur la staging
+USE_MERGE = os.getenv("USE_MERGE", "false").lower() in {
+    "1", "true", "yes", "y"}
+
+# Au-delà : DROP de l'index unique, DELETE + INSERT en masse, puis
+# recréation de l'index (une seule transaction), à condition que le lot
+# représente au moins INDEX_REBUILD_RATIO de la table (pg_class.reltuples)
+INDEX_REBUILD_THRESHOLD = int(os.getenv("INDEX_REBUILD_THRESHOLD", "200000"))
+INDEX_REBUILD_RATIO = float(os.getenv("INDEX_REBUILD_RATIO", "0.5"))
+
 # Dossier de sortie
 DROP_DIR = Path(
     os.getenv("DROP_DIR", r"C:\Users\loudo\Downloads\Pipeline_Python\med_demo\drop")).expanduser()
 
-# Colonnes attendues par la table de staging (ordre strict)
-COLS = [
-    "annee", "profession_sante", "region", "libelle_region",
-    "departement", "libelle_departement",
-    "classe_age", "libelle_classe_age", "libelle_sexe",
-    "effectif", "densite",
-    "vision_generale_all", "vision_generale_prescriptions", "vision_profession_territoire"
-]
+# Colonnes attendues par la table de staging (ordre strict), partagées
+# avec download_and_load_2022 (types de tmp_stg : staging_col_types)
+COLS = STAGING_COLS
 
 # ========= CONNEXION POSTGRES =========
 
@@ -61,12 +80,17 @@ PG_CONN = dict(
 if not PG_CONN["password"]:
     raise RuntimeError("PGPASSWORD manquant (env/Secrets).")
 
+# DSN calculé une fois ; pool créé à la première connexion demandée
+DSN = psycopg2.extensions.make_dsn(**PG_CONN)
+_get_pool = LazyPool(4, DSN)
+
 
 # ========= ETAPE 1 : INGESTION =========
 def fetch_parquet_df(year: Optional[int] = None) -> pd.DataFrame:
     """
     Télécharge l'export depuis data.ameli.fr :
-    - essaie d'abord Parquet, puis fallback CSV
+    - essaie d'abord Parquet (colonnes COLS + row groups de l'année
+      seulement), puis fallback CSV
     - filtre sur l'année avec refine=annee:YYYY
     - limit=-1 pour tout rapatrier
     - teste deux slugs (nouveau + ancien) pour compatibilité
@@ -92,7 +116,14 @@ def fetch_parquet_df(year: Optional[int] = None) -> pd.DataFrame:
         parquet_url = f"{base}/parquet?{urlencode(params, doseq=True)}"
         log.info("Lecture Parquet… %s", parquet_url)
         try:
-            df = pd.read_parquet(parquet_url, engine="pyarrow")
+            # footer + column chunks de COLS uniquement (GET Range), filtre
+            # année poussé au lecteur (élagage des row groups)
+            fragment = open_parquet_url(parquet_url, columns=COLS, year=year)
+            schema = fragment.physical_schema
+            columns = [c for c in COLS if c in schema.names]
+            filt = year_filter(schema, year) if year is not None else None
+            tbl = fragment.to_table(columns=columns, filter=filt)
+            df = tbl.to_pandas(types_mapper=pd.ArrowDtype)
             return df
         except Exception as e:
             errors.append(f"PARQUET {ds} -> {e}")
@@ -102,7 +133,7 @@ def fetch_parquet_df(year: Optional[int] = None) -> pd.DataFrame:
         csv_url = f"{base}/csv?{urlencode(params, doseq=True)}"
         log.info("Lecture CSV… %s", csv_url)
         try:
-            df = pd.read_csv(csv_url)
+            df = pd.read_csv(csv_url, dtype_backend="pyarrow")
             return df
         except Exception as e:
             errors.append(f"CSV {ds} -> {e}")
@@ -112,49 +143,76 @@ def fetch_parquet_df(year: Optional[int] = None) -> pd.DataFrame:
 
 
 # ========= ETAPE 2 : PREPARATION =========
-def prepare_dataframe(df: pd.DataFrame, year: int) -> pd.DataFrame:
+def _is_date_dtype(s: pd.Series) -> bool:
     """
-    - Aligne sur COLS (ajoute les colonnes manquantes)
-    - Normalise 'annee' (date -> année Int64, sinon to_numeric)
-    - Filtre par 'year'
-    - Cast 'effectif'/'densite'
+    datetime64 (numpy/tz) ou date/timestamp Arrow (pd.ArrowDtype).
     """
-    log.info("Préparation du DataFrame…")
-    log.debug("Colonnes reçues: %s", list(df.columns))
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return True
+    typ = getattr(s.dtype, "pyarrow_dtype", None)
+    return typ is not None and (pa.types.is_date(typ) or pa.types.is_timestamp(typ))
 
-    # 1) Colonnes manquantes
-    missing = [c for c in COLS if c not in df.columns]
-    if missing:
-        log.warning("Colonnes manquantes → ajout en None: %s", missing)
-        for c in missing:
-            df[c] = None
-    df = df[COLS]
 
-    # 2) Normaliser 'annee'
+def _annee_to_int(a: pd.Series) -> pd.Series:
+    """
+    'annee' -> Int64 (branche sur le dtype : pas de to_datetime sur une
+    colonne déjà numérique).
+    """
+    if _is_date_dtype(a):
+        log.debug("'annee' de type date → extraction année OK")
+        return a.dt.year.astype("Int64")
+    if pd.api.types.is_integer_dtype(a) or pd.api.types.is_float_dtype(a):
+        log.debug("'annee' numérique → conversion Int64 OK")
+        return pd.to_numeric(a, errors="coerce").astype("Int64")
     try:
-        a_dt = pd.to_datetime(df["annee"], errors="coerce", utc=False)
+        a_dt = pd.to_datetime(a, errors="coerce", utc=False)
         if a_dt.notna().any():
-            df["annee"] = a_dt.dt.year.astype("Int64")
             log.debug("'annee' détectée comme date → extraction année OK")
-        else:
-            df["annee"] = pd.to_numeric(
-                df["annee"], errors="coerce").astype("Int64")
-            log.debug("'annee' non date → conversion numérique OK")
+            return a_dt.dt.year.astype("Int64")
+        log.debug("'annee' non date → conversion numérique OK")
     except Exception as e:
         log.warning(
             "to_datetime('annee') a échoué (%s) → fallback to_numeric", e)
-        df["annee"] = pd.to_numeric(
-            df["annee"], errors="coerce").astype("Int64")
+    return pd.to_numeric(a, errors="coerce").astype("Int64")
 
-    # 3) Filtre année (filet de sécurité)
+
+def prepare_dataframe(df: pd.DataFrame, year: int) -> pd.DataFrame:
+    """
+    - Normalise 'annee' (date -> année Int64, sinon to_numeric)
+    - Filtre par 'year' (avant tout autre traitement)
+    - Aligne sur COLS (ajoute les colonnes manquantes)
+    - Cast 'effectif'/'densite'
+    """
+    log.info("Préparation du DataFrame…")
+    log.debug("Colonnes reçues: %s", list(df.columns))
+
+    # 1) Normaliser 'annee' sur la colonne brute uniquement
+    if "annee" in df.columns:
+        annee = _annee_to_int(df["annee"])
+    else:
+        annee = pd.Series(pd.NA, index=df.index, dtype="Int64")
+
+    # 2) Filtre année (filet de sécurité) : les étapes suivantes ne
+    #    traitent que les lignes conservées
     before = len(df)
-    df = df[df["annee"] == year].copy()
+    keep = (annee == year).fillna(False).to_numpy(dtype=bool)
+    df = df.loc[keep]
     log.info("Filtre année %s : %s → %s lignes",
              year, f"{before:,}", f"{len(df):,}")
 
-    # 4) Casts numériques
-    df["effectif"] = pd.to_numeric(df["effectif"], errors="coerce")
-    df["densite"] = pd.to_numeric(df["densite"], errors="coerce")
+    # 3) Colonnes manquantes
+    missing = [c for c in COLS if c not in df.columns]
+    if missing:
+        log.warning("Colonnes manquantes → ajout en NULL: %s", missing)
+    # projection + ajout des manquantes en une passe (pas de colonne objet)
+    df = df.reindex(columns=COLS)
+    df["annee"] = annee[keep]
+
+    # 4) Casts numériques (source Parquet : colonnes déjà typées Arrow,
+    #    seul le fallback CSV / colonnes texte paient la conversion)
+    for c in ("effectif", "densite"):
+        if not pd.api.types.is_numeric_dtype(df[c]):
+            df[c] = pd.to_numeric(df[c], errors="coerce")
 
     log.info("Préparation terminée : %s lignes", f"{len(df):,}")
     log.debug("dtypes finaux: %s", {k: str(v) for k, v in df.dtypes.items()})
@@ -162,121 +220,348 @@ def prepare_dataframe(df: pd.DataFrame, year: int) -> pd.DataFrame:
 
 
 # ========= ETAPE 3 : UPSERT STAGING =========
-def upsert_to_staging(df: pd.DataFrame, year: int) -> None:
+# COPY texte FREEZE : la table cible doit être créée ou TRUNCATE dans la
+# même transaction (lignes écrites déjà gelées, pas de VACUUM FREEZE ultérieur)
+_COPY_FREEZE_SQL = (
+    "COPY {target} (" + ", ".join(COLS) + ") FROM STDIN "
+    "WITH (FORMAT text, FREEZE TRUE, DELIMITER E'\\t', NULL '')"
+)
+
+# Lignes valides de l'année en staging (volume journalisé)
+_COUNT_SQL = """
+    SELECT COUNT(*)
+    FROM "pro_sante".stg_pro_sante_raw
+    WHERE annee = %s
+      AND region <> '99'
+      AND departement <> '999'
+      AND libelle_sexe IN ('hommes','femmes')
+      AND classe_age <> 'tout_age'
+"""
+
+# Clé unique de la staging
+PK = ["annee", "region", "departement",
+      "profession_sante", "classe_age", "libelle_sexe"]
+
+# Index unique (et contrainte éventuelle) portant exactement sur PK
+_UNIQUE_INDEX_SQL = """
+    SELECT i.indexrelid::regclass::text,
+           pg_get_indexdef(i.indexrelid),
+           c.conname,
+           pg_get_constraintdef(c.oid)
+    FROM pg_index i
+    LEFT JOIN pg_constraint c
+      ON c.conindid = i.indexrelid AND c.contype IN ('p', 'u')
+    WHERE i.indrelid = '"pro_sante".stg_pro_sante_raw'::regclass
+      AND i.indisunique
+      AND i.indpred IS NULL
+      AND (SELECT array_agg(a.attname::text ORDER BY a.attname)
+           FROM pg_attribute a
+           WHERE a.attrelid = i.indrelid AND a.attnum = ANY (i.indkey)) = %s::text[]
+    LIMIT 1
+"""
+
+# Taille estimée de la staging (pg_class.reltuples ; -1 si jamais analysée)
+_RELTUPLES_SQL = """
+    SELECT reltuples::bigint
+    FROM pg_class
+    WHERE oid = '"pro_sante".stg_pro_sante_raw'::regclass
+"""
+
+# Remplacement en masse (index unique supprimé) : DELETE des clés rechargées
+# et INSERT dans la même instruction. Mêmes règles que l'UPSERT par lots :
+# doublons de tmp_stg résolus par la dernière ligne copiée, et pour une clé
+# déjà présente seuls effectif/densite changent (libelle_*/vision_* conservés).
+_BULK_REPLACE_SQL = """
+    WITH t AS (
+      SELECT DISTINCT ON (annee, region, departement, profession_sante, classe_age, libelle_sexe)
+        *
+      FROM tmp_stg
+      WHERE annee = %s
+      ORDER BY annee, region, departement, profession_sante, classe_age, libelle_sexe, rn DESC
+    ), o AS (
+      DELETE FROM "pro_sante".stg_pro_sante_raw s
+      USING t
+      WHERE s.annee = t.annee
+        AND s.region = t.region
+        AND s.departement = t.departement
+        AND s.profession_sante = t.profession_sante
+        AND s.classe_age = t.classe_age
+        AND s.libelle_sexe = t.libelle_sexe
+      RETURNING s.*
+    )
+    INSERT INTO "pro_sante".stg_pro_sante_raw (
+      annee, profession_sante, region, libelle_region,
+      departement, libelle_departement,
+      classe_age, libelle_classe_age, libelle_sexe,
+      effectif, densite,
+      vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
+    )
+    SELECT
+      t.annee, t.profession_sante, t.region,
+      CASE WHEN o.annee IS NULL THEN t.libelle_region ELSE o.libelle_region END,
+      t.departement,
+      CASE WHEN o.annee IS NULL THEN t.libelle_departement ELSE o.libelle_departement END,
+      t.classe_age,
+      CASE WHEN o.annee IS NULL THEN t.libelle_classe_age ELSE o.libelle_classe_age END,
+      t.libelle_sexe,
+      t.effectif, t.densite,
+      CASE WHEN o.annee IS NULL THEN t.vision_generale_all ELSE o.vision_generale_all END,
+      CASE WHEN o.annee IS NULL THEN t.vision_generale_prescriptions ELSE o.vision_generale_prescriptions END,
+      CASE WHEN o.annee IS NULL THEN t.vision_profession_territoire ELSE o.vision_profession_territoire END
+    FROM t
+    LEFT JOIN o
+      ON  o.annee = t.annee
+      AND o.region = t.region
+      AND o.departement = t.departement
+      AND o.profession_sante = t.profession_sante
+      AND o.classe_age = t.classe_age
+      AND o.libelle_sexe = t.libelle_sexe
+"""
+
+# PG15+ et USE_MERGE : même lot via MERGE (un seul scan de jointure, pas
+# d'arbitre ON CONFLICT). Sans verrou de clé unique : une insertion
+# concurrente (watch_parquet) sur une même clé → unique_violation, le lot
+# est alors rejoué avec STAGING_UPSERT_SQL.
+_MERGE_SQL = """
+    MERGE INTO "pro_sante".stg_pro_sante_raw s
+    USING (
+      SELECT *
+      FROM tmp_stg
+      WHERE annee = %s
+        AND rn > %s AND rn <= %s
+    ) t
+    ON  s.annee = t.annee
+    AND s.region = t.region
+    AND s.departement = t.departement
+    AND s.profession_sante = t.profession_sante
+    AND s.classe_age = t.classe_age
+    AND s.libelle_sexe = t.libelle_sexe
+    WHEN MATCHED THEN UPDATE SET
+      effectif = t.effectif,
+      densite  = t.densite
+    WHEN NOT MATCHED THEN INSERT (
+      annee, profession_sante, region, libelle_region,
+      departement, libelle_departement,
+      classe_age, libelle_classe_age, libelle_sexe,
+      effectif, densite,
+      vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
+    ) VALUES (
+      t.annee, t.profession_sante, t.region, t.libelle_region,
+      t.departement, t.libelle_departement,
+      t.classe_age, t.libelle_classe_age, t.libelle_sexe,
+      t.effectif, t.densite,
+      t.vision_generale_all, t.vision_generale_prescriptions, t.vision_profession_territoire
+    );
+"""
+
+
+def _bulk_replace(cur, year: int, nrows: int) -> bool:
+    """
+    Gros volumes : DROP de l'index unique, DELETE + INSERT en masse,
+    recréation de l'index. Tout dans la transaction courante (atomique ;
+    la table est verrouillée en ACCESS EXCLUSIVE jusqu'au commit).
+    False (→ UPSERT par lots) si le lot est petit devant la table (la
+    reconstruction porterait sur toutes les années) ou si aucun index
+    unique sur PK n'est trouvé.
     """
-    COPY vers table temporaire -> UPSERT vers pro_sante.stg_pro_sante_raw
+    cur.execute(_RELTUPLES_SQL)
+    (reltuples,) = cur.fetchone()
+    if nrows < INDEX_REBUILD_RATIO * max(reltuples, 0):
+        log.info("%s lignes pour ~%s en staging → UPSERT par lots",
+                 f"{nrows:,}", f"{reltuples:,}")
+        return False
+
+    cur.execute(_UNIQUE_INDEX_SQL, (sorted(PK),))
+    row = cur.fetchone()
+    if row is None:
+        log.warning("Index unique sur %s introuvable → UPSERT par lots", PK)
+        return False
+    index_name, index_def, con_name, con_def = row
+
+    table = '"pro_sante".stg_pro_sante_raw'
+    if con_name:
+        con_ident = psycopg2.extensions.quote_ident(con_name, cur)
+        log.info("DROP CONSTRAINT %s…", con_name)
+        cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {con_ident};")
+    else:
+        log.info("DROP INDEX %s…", index_name)
+        cur.execute(f"DROP INDEX {index_name};")
+
+    log.info("DELETE + INSERT en masse vers stg_pro_sante_raw pour %s…", year)
+    cur.execute(_BULK_REPLACE_SQL, (year,))
+
+    log.info("Recréation de l'index unique %s…", index_name)
+    if con_name:
+        cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {con_ident} {con_def};")
+    else:
+        cur.execute(index_def)
+    return True
+
+
+def upsert_to_staging(conn, df: pd.DataFrame, year: int,
+                      full_reload: bool = False) -> int:
+    """
+    COPY BINARY (Arrow) vers table temporaire -> UPSERT vers
+    pro_sante.stg_pro_sante_raw par lots de UPSERT_BATCH lignes (une transaction par lot).
     Contrainte/Index unique requis sur :
     (annee, region, departement, profession_sante, classe_age, libelle_sexe)
+
+    full_reload=True : TRUNCATE de la staging puis COPY FREEZE direct
+    (toutes les années présentes en staging sont effacées).
+    Retourne le nombre de lignes valides en staging pour l'année, compté
+    dans la dernière transaction du chargement.
     """
     if df.empty:
         log.warning("Aucune ligne pour %s → rien à insérer", year)
-        return
-
-    # Buffer TSV
-    buf = StringIO()
-    df.to_csv(buf, index=False, header=False, sep="\t", na_rep="")
-    buf.seek(0)
-
-    with psycopg2.connect(**PG_CONN) as conn:
         with conn.cursor() as cur:
-            log.info("Création table temporaire tmp_stg…")
-            cur.execute(
-                """
-                CREATE TEMP TABLE tmp_stg
-                (LIKE "pro_sante".stg_pro_sante_raw INCLUDING DEFAULTS)
-                ON COMMIT DROP;
-                """
-            )
-
-            log.info("COPY vers tmp_stg (%s lignes)…", f"{len(df):,}")
-            cur.copy_from(buf, "tmp_stg", sep="\t", null="", columns=COLS)
-
-            log.info("UPSERT vers stg_pro_sante_raw…")
-            cur.execute(
-                """
-                INSERT INTO "pro_sante".stg_pro_sante_raw (
-                  annee, profession_sante, region, libelle_region,
-                  departement, libelle_departement,
-                  classe_age, libelle_classe_age, libelle_sexe,
-                  effectif, densite,
-                  vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
-                )
-                SELECT
-                  annee, profession_sante, region, libelle_region,
-                  departement, libelle_departement,
-                  classe_age, libelle_classe_age, libelle_sexe,
-                  effectif, densite,
-                  vision_generale_all, vision_generale_prescriptions, vision_profession_territoire
-                FROM tmp_stg
-                WHERE annee = %s
-                ON CONFLICT (annee, region, departement, profession_sante, classe_age, libelle_sexe)
-                DO UPDATE SET
-                  effectif = EXCLUDED.effectif,
-                  densite  = EXCLUDED.densite;
-                """,
-                (year,),
-            )
+            cur.execute(_COUNT_SQL, (year,))
+            (cnt,) = cur.fetchone()
         conn.commit()
-        log.info("[OK] UPSERT terminé pour %s", year)
+        return cnt
+
+    with conn.cursor() as cur:
+        # Réglages de session (le chargement couvre plusieurs transactions)
+        cur.execute("""
+            SET synchronous_commit = off;
+            SET work_mem = '256MB';
+            SET maintenance_work_mem = '512MB';
+        """)
+        try:
+            if full_reload:
+                # Types exacts de la staging inconnus ici → COPY texte
+                buf = StringIO()
+                df.to_csv(buf, index=False, header=False, sep="\t", na_rep="")
+                buf.seek(0)
+
+                log.warning("FULL_RELOAD : TRUNCATE stg_pro_sante_raw "
+                            "(toutes années) + COPY FREEZE…")
+                cur.execute('TRUNCATE "pro_sante".stg_pro_sante_raw;')
+                cur.copy_expert(
+                    _COPY_FREEZE_SQL.format(
+                        target='"pro_sante".stg_pro_sante_raw'), buf)
+                cur.execute(_COUNT_SQL, (year,))
+                (cnt,) = cur.fetchone()
+                conn.commit()
+            else:
+                log.info("Création table temporaire tmp_stg…")
+                col_types = staging_col_types(cur)
+                cur.execute(temp_table_ddl("tmp_stg", col_types,
+                                           on_commit="PRESERVE ROWS"))
+                cur.execute("""
+                    ALTER TABLE tmp_stg
+                      ADD COLUMN rn bigint GENERATED ALWAYS AS IDENTITY;
+                """)
+
+                # COPY BINARY depuis Arrow : ni formatage texte côté Python,
+                # ni parsing numérique côté serveur
+                log.info("COPY BINARY FREEZE vers tmp_stg (%s lignes)…",
+                         f"{len(df):,}")
+                table = pa.Table.from_pandas(df[COLS], preserve_index=False)
+                copy_table_binary(cur, table, "tmp_stg", col_types, freeze=True)
+                cur.execute("CREATE INDEX ON tmp_stg (rn); ANALYZE tmp_stg;")
+                conn.commit()
+
+                if (len(df) > INDEX_REBUILD_THRESHOLD
+                        and _bulk_replace(cur, year, len(df))):
+                    cur.execute(_COUNT_SQL, (year,))
+                    (cnt,) = cur.fetchone()
+                    conn.commit()
+                else:
+                    use_merge = USE_MERGE and conn.server_version >= 150000
+                    log.info("%s vers stg_pro_sante_raw (lots de %s)…",
+                             "MERGE" if use_merge else "UPSERT",
+                             f"{UPSERT_BATCH:,}")
+                    for lo in range(0, len(df), UPSERT_BATCH):
+                        params = (year, lo, lo + UPSERT_BATCH)
+                        if use_merge:
+                            try:
+                                cur.execute(_MERGE_SQL, params)
+                            except psycopg2.errors.UniqueViolation:
+                                # clé insérée en parallèle (watcher) : le lot
+                                # est rejoué avec l'arbitre ON CONFLICT
+                                conn.rollback()
+                                log.warning("MERGE lot %s : clé concurrente → "
+                                            "rejeu en INSERT ON CONFLICT", lo)
+                                cur.execute(STAGING_UPSERT_SQL, params)
+                        else:
+                            cur.execute(STAGING_UPSERT_SQL, params)
+                        if lo + UPSERT_BATCH >= len(df):
+                            # dernier lot : comptage dans la même transaction
+                            cur.execute(_COUNT_SQL, (year,))
+                            (cnt,) = cur.fetchone()
+                        conn.commit()
+        finally:
+            conn.rollback()
+            cur.execute("""
+                DROP TABLE IF EXISTS tmp_stg;
+                RESET synchronous_commit;
+                RESET work_mem;
+                RESET maintenance_work_mem;
+            """)
+            conn.commit()
+    log.info("[OK] UPSERT terminé pour %s", year)
+
+    # VACUUM hors transaction : met à jour la visibility map (Index-Only
+    # Scan sur idx_stg_valid) et les statistiques du planner
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            log.info("VACUUM ANALYZE stg_pro_sante_raw…")
+            cur.execute('VACUUM ANALYZE "pro_sante".stg_pro_sante_raw;')
+    finally:
+        conn.autocommit = False
+    return cnt
 
 
 # ========= ENTRYPOINT =========
-def main(year: Optional[int] = None):
+def load_staging(conn, y: int) -> None:
     """
     Pipeline staging :
       1) téléchargement export filtré sur l'année
       2) préparation DataFrame
       3) UPSERT vers staging
       + sauvegardes locales optionnelles
+    La connexion est fournie par l'appelant (pipeline_runner ou main).
     """
-    # Année résolue au runtime (ENV > argument > défaut)
-    y = int(os.getenv("YEAR", year if year is not None else 2022))
-
     log.info("=== DÉBUT STAGING ===")
-    log.info("Paramètres: YEAR=%s | SAVE_LOCAL=%s", y, SAVE_LOCAL)
+    log.info("Paramètres: YEAR=%s | SAVE_LOCAL=%s | FULL_RELOAD=%s",
+             y, SAVE_LOCAL, FULL_RELOAD)
     log.info("DROP_DIR: %s", DROP_DIR)
 
     # 1) Ingestion
     df_raw = fetch_parquet_df(year=y)
 
-    # (optionnel) sauvegarde du brut
+    # (optionnel) sauvegarde du brut (Feather zstd : écriture rapide)
     if SAVE_LOCAL:
         try:
             DROP_DIR.mkdir(parents=True, exist_ok=True)
-            raw_parquet = DROP_DIR / f"pro_sante_raw_{y}.parquet"
-            df_raw.to_parquet(raw_parquet, index=False)
-            log.info("Parquet brut sauvegardé → %s", raw_parquet)
+            raw_feather = DROP_DIR / f"pro_sante_raw_{y}.feather"
+            feather.write_feather(
+                pa.Table.from_pandas(df_raw, preserve_index=False), raw_feather,
+                compression="zstd", compression_level=3)
+            log.info("Feather brut sauvegardé → %s", raw_feather)
         except Exception as e:
-            log.warning("Impossible de sauvegarder le Parquet brut: %s", e)
+            log.warning("Impossible de sauvegarder le Feather brut: %s", e)
 
     # 2) Préparation
     df_ready = prepare_dataframe(df_raw, y)
 
-    # (optionnel) export CSV d’inspection
+    # (optionnel) export Parquet zstd d’inspection (relisible par read_any)
     if SAVE_LOCAL:
         try:
-            out_csv = DROP_DIR / f"pro_sante_{y}_ready.csv"
-            df_ready.to_csv(out_csv, index=False, sep=";")
-            size_mb = out_csv.stat().st_size / (1024 * 1024)
-            log.info("CSV préparé écrit → %s (%.1f Mo)", out_csv, size_mb)
+            out_parquet = DROP_DIR / f"pro_sante_{y}_ready.parquet"
+            pq.write_table(
+                pa.Table.from_pandas(df_ready, preserve_index=False),
+                out_parquet, compression="zstd")
+            size_mb = out_parquet.stat().st_size / (1024 * 1024)
+            log.info("Parquet préparé écrit → %s (%.1f Mo)", out_parquet, size_mb)
         except Exception as e:
-            log.warning("Impossible d’écrire le CSV préparé: %s", e)
+            log.warning("Impossible d’écrire le Parquet préparé: %s", e)
 
-    # 3) UPSERT staging
-    upsert_to_staging(df_ready, y)
-    # 4) Compte des lignes staging pour l'année et log volume annuel
-    with psycopg2.connect(**PG_CONN) as conn, conn.cursor() as cur:
-        cur.execute("""
-            SELECT COUNT(*) 
-            FROM "pro_sante".stg_pro_sante_raw
-            WHERE annee = %s
-              AND region <> '99'
-              AND departement <> '999'
-              AND libelle_sexe IN ('hommes','femmes')
-              AND classe_age <> 'tout_age'
-        """, (y,))
-        (cnt,) = cur.fetchone()
+    # 3) UPSERT staging (+ compte des lignes staging pour l'année)
+    cnt = upsert_to_staging(conn, df_ready, y, full_reload=FULL_RELOAD)
 
+    # 4) Log volume annuel
     log_volume(
         pipeline="pro_sante",
         entity="stg_pro_sante_raw",
@@ -290,8 +575,28 @@ def main(year: Optional[int] = None):
     log.info("=== FIN STAGING ===")
 
 
+def main(year: Optional[int] = None, conn=None):
+    # Année résolue au runtime (ENV > argument > défaut)
+    y = int(os.getenv("YEAR", year if year is not None else 2022))
+    if conn is not None:
+        load_staging(conn, y)
+        return
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        with conn:
+            load_staging(conn, y)
+    finally:
+        pool.putconn(conn)
+
+
 if __name__ == "__main__":
     # Permet aussi l'exécution directe du fichier :
     #   python staging_loader.py  (utilise YEAR de l'ENV ou 2022)
     #   YEAR=2021 python staging_loader.py
+    logging.basicConfig(
+        level=getattr(logging, LOG_LEVEL, logging.INFO),
+        format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
     main()
@@ -1,11 +1,29 @@
 import os
 import time
 import glob
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
 import psycopg2
-import psycopg2.extras as extras
+import psycopg2.extensions
 from pathlib import Path
 
+from pg_utils import LazyPool, prepare
+
+try:
+    # événements fichiers de l'OS (inotify / ReadDirectoryChangesW)
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog absent → polling glob
+    FileSystemEventHandler = object
+    Observer = None
+
 
 # ====== CONFIG ======
 # dossier à surveiller
@@ -31,6 +49,9 @@ PG = {
 if not PG["password"]:
     raise RuntimeError("PGPASSWORD manquant (env/Secrets).")
 
+# DSN calculé une fois ; pool créé à la première connexion demandée
+DSN = psycopg2.extensions.make_dsn(**PG)
+
 TABLE = '"pro_sante".stg_pro_sante_raw'
 
 # Colonnes attendues (ton schéma Parquet)
@@ -41,9 +62,64 @@ COLUMNS = [
     "vision_profession_territoire"
 ]
 
+# Colonnes texte (nettoyage strip, typage string à la lecture CSV)
+TEXT_COLUMNS = [
+    "profession_sante", "region", "libelle_region", "departement",
+    "libelle_departement", "classe_age", "libelle_classe_age", "libelle_sexe",
+    "vision_generale_all", "vision_generale_prescriptions", "vision_profession_territoire"
+]
+
 PK = ["annee", "region", "departement",
       "profession_sante", "classe_age", "libelle_sexe"]
 
+# Extensions prises en charge par read_any
+SUFFIXES = {".parquet", ".csv"}
+
+# Fichiers traités en parallèle (une connexion du pool par worker)
+WATCH_WORKERS = int(os.getenv("WATCH_WORKERS", "4"))
+
+# dtypes pandas adossés à Arrow (NA = NULL au COPY)
+INT64 = pd.ArrowDtype(pa.int64())
+FLOAT64 = pd.ArrowDtype(pa.float64())
+STRING = pd.ArrowDtype(pa.string())
+
+# Libellés de sexe homogénéisés (clé : libellé en minuscules)
+SEX_MAP = {
+    "homme": "hommes", "hommes": "hommes",
+    "femme": "femmes", "femmes": "femmes",
+    "masculin": "hommes", "féminin": "femmes"
+}
+
+_get_pool = LazyPool(WATCH_WORKERS, DSN)
+
+
+# ====== SQL (construit une fois) ======
+_INSERT_COLS = ",".join(COLUMNS)
+_CONFLICT_COLS = ",".join(PK)
+# on met à jour tout sauf la PK
+_SET_CLAUSE = ", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNS if c not in PK)
+
+# Table de transit par connexion, vidée à chaque commit
+_STAGE_DDL = f"""
+    CREATE TEMP TABLE IF NOT EXISTS tmp_stg
+    (LIKE {TABLE} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;
+"""
+
+_COPY_SQL = (f"COPY tmp_stg ({_INSERT_COLS}) FROM STDIN "
+             "WITH (FORMAT csv, DELIMITER E'\\t', NULL '')")
+
+# ORDER BY clé : verrous pris dans le même ordre par les workers
+# concurrents (pas d'interblocage sur des clés communes)
+_UPSERT_SQL = f"""
+    INSERT INTO {TABLE} ({_INSERT_COLS})
+    SELECT {_INSERT_COLS} FROM tmp_stg
+    ORDER BY {_CONFLICT_COLS}
+    ON CONFLICT ({_CONFLICT_COLS})
+    DO UPDATE SET {_SET_CLAUSE}
+"""
+
+
+
 # ====== FONCTIONS ======
 
 
@@ -53,12 +129,32 @@ def read_any(path: str) -> pd.DataFrame:
 
     ext = os.path.splitext(path)[1].lower()
     if ext == ".parquet":
-        df = pd.read_parquet(path, engine="pyarrow")
+        fmt = "parquet"
     elif ext == ".csv":
-        df = pd.read_csv(path, encoding="utf-8", sep=",")
+        # lecteur CSV Arrow multithreadé ; codes texte forcés en string
+        # (pas d'inférence entière qui perdrait les zéros de tête : "01")
+        fmt = ds.CsvFileFormat(convert_options=pacsv.ConvertOptions(
+            column_types={c: pa.string() for c in TEXT_COLUMNS},
+            strings_can_be_null=True))
     else:
         raise ValueError(f"Format non supporté: {ext}")
 
+    # projection : seules les colonnes attendues sont décodées
+    dataset = ds.dataset(path, format=fmt)
+    cols = [c for c in COLUMNS if c in dataset.schema.names]
+    tbl = dataset.to_table(columns=cols)
+
+    # nettoyage texte en Arrow (un kernel C++ par colonne, pas d'objets
+    # Python)
+    for c in TEXT_COLUMNS:
+        if c in tbl.column_names:
+            i = tbl.schema.get_field_index(c)
+            tbl = tbl.set_column(i, c, pc.utf8_trim_whitespace(
+                pc.cast(tbl[c], pa.string())))
+    # dtypes nullables adossés à Arrow dès la lecture (équivalent de
+    # convert_dtypes(dtype_backend="pyarrow"), sans passe supplémentaire)
+    df = tbl.to_pandas(types_mapper=pd.ArrowDtype)
+
     # garder les colonnes attendues si le fichier en contient plus
     keep = [c for c in COLUMNS if c in df.columns]
     df = df[keep].copy()
@@ -66,42 +162,40 @@ def read_any(path: str) -> pd.DataFrame:
     # ---- Typages / normalisation ----
     # annee peut être date -> extraire l'année
     if "annee" in df.columns:
-        if pd.api.types.is_datetime64_any_dtype(df["annee"]):
-            df["annee"] = df["annee"].dt.year.astype("Int64")
-        else:
-            y = pd.to_datetime(df["annee"], errors="coerce").dt.year
-            y = y.fillna(pd.to_numeric(df["annee"], errors="coerce"))
-            df["annee"] = y.astype("Int64")
-
+        a = df["annee"]
+        typ = a.dtype.pyarrow_dtype
+        if pa.types.is_date(typ) or pa.types.is_timestamp(typ):
+            a = a.dt.year
+        elif not (pa.types.is_integer(typ) or pa.types.is_floating(typ)):
+            # texte : date ISO ou année seule
+            y = pd.to_datetime(a, errors="coerce").dt.year
+            a = y.fillna(pd.to_numeric(a, errors="coerce"))
+        df["annee"] = a.astype(INT64)
+
+    # effectif manquant → NULL (plus de fillna(0) qui le confondait avec 0)
     if "effectif" in df.columns:
-        df["effectif"] = pd.to_numeric(
-            df["effectif"], errors="coerce").fillna(0).astype("Int64")
+        if not pd.api.types.is_numeric_dtype(df["effectif"]):
+            df["effectif"] = pd.to_numeric(
+                df["effectif"], errors="coerce", dtype_backend="pyarrow")
+        df["effectif"] = df["effectif"].astype(INT64)
     if "densite" in df.columns:
-        df["densite"] = pd.to_numeric(df["densite"], errors="coerce")
-
-    # nettoyage texte (utiliser .str.strip() sur Series)
-    for c in ["profession_sante", "region", "libelle_region", "departement",
-              "libelle_departement", "classe_age", "libelle_classe_age", "libelle_sexe",
-              "vision_generale_all", "vision_generale_prescriptions", "vision_profession_territoire"]:
-        if c in df.columns:
-            df[c] = df[c].astype("string").str.strip()
+        if not pd.api.types.is_numeric_dtype(df["densite"]):
+            df["densite"] = pd.to_numeric(
+                df["densite"], errors="coerce", dtype_backend="pyarrow")
+        df["densite"] = df["densite"].astype(FLOAT64)
 
     # homogénéiser le sexe
+    # (catégories uniques seulement : quelques libellés au lieu de N lignes)
     if "libelle_sexe" in df.columns:
-        sex = df["libelle_sexe"].str.lower().str.strip()
-        df["libelle_sexe"] = sex.map({
-            "homme": "hommes", "hommes": "hommes",
-            "femme": "femmes", "femmes": "femmes",
-            "masculin": "hommes", "féminin": "femmes"
-        }).fillna(sex)
+        cat = df["libelle_sexe"].astype("category")
+        mapping = {c: SEX_MAP.get(c.strip().lower(), c.strip().lower())
+                   for c in cat.cat.categories}
+        df["libelle_sexe"] = cat.map(mapping).astype(STRING)
 
     # ---- Lignes indispensables pour la PK ----
     df = df.dropna(subset=["annee", "region", "departement",
                    "profession_sante", "classe_age", "libelle_sexe"])
 
-    # remplacer NaN par None pour psycopg2
-    df = df.where(pd.notnull(df), None)
-
     print(
         f"[debug] lu {len(df)} lignes après normalisation (fichier: {os.path.basename(path)})")
     return df
@@ -117,58 +211,157 @@ def upsert_dataframe(conn, df: pd.DataFrame):
             df[c] = None
     df = df[COLUMNS]
 
-    # Construction clause INSERT VALUES %s (execute_values)
-    insert_cols = ",".join(COLUMNS)
-    conflict_cols = ",".join(PK)
-
-    # on met à jour tout sauf la PK
-    update_cols = [c for c in COLUMNS if c not in PK]
-    set_clause = ", ".join([f'{c} = EXCLUDED.{c}' for c in update_cols])
-
-    sql = f"""
-    INSERT INTO {TABLE} ({insert_cols})
-    VALUES %s
-    ON CONFLICT ({conflict_cols})
-    DO UPDATE SET {set_clause};
-    """
+    # Buffer TSV (format CSV : guillemets gérés, NA/Int64 → champ vide)
+    buf = StringIO()
+    df.to_csv(buf, index=False, header=False, sep="\t", na_rep="")
+    buf.seek(0)
 
-    records = [tuple(None if pd.isna(v) else int(v) if isinstance(v, (pd.Int64Dtype().type,)) else v
-                     for v in row)
-               for row in df.itertuples(index=False, name=None)]
+    # Table de transit + PREPARE watch_upsert une fois par connexion (plan
+    # de l'UPSERT réutilisé pour chaque fichier), validés à part
+    with conn:
+        prepare(conn, "watch_upsert", _UPSERT_SQL, setup=_STAGE_DDL)
 
+    # COPY vers la table de transit puis UPSERT préparé, une transaction par fichier
     with conn:
         with conn.cursor() as cur:
-            extras.execute_values(cur, sql, records, page_size=10000)
-    return len(records)
+            cur.copy_expert(_COPY_SQL, buf)
+            cur.execute("EXECUTE watch_upsert")
+            return cur.rowcount
 
 # ====== MAIN LOOP ======
 
 
+def process_one(pool, path: str, wait_stable: bool = False) -> None:
+    # exécuté dans un worker : toute erreur (attente, connexion, lecture,
+    # upsert) est journalisée ici, le Future n'est jamais relu
+    conn = None
+    try:
+        # attente de fin de copie dans le worker (pas dans le dispatcher)
+        if wait_stable and not _wait_stable(path):
+            return
+        conn = pool.getconn()
+        df = read_any(path)
+        inserted = upsert_dataframe(conn, df)
+        print(
+            f"[watch] {os.path.basename(path)} → upsert {inserted} lignes")
+    except Exception as e:
+        print(f"[watch][ERREUR] {os.path.basename(path)}: {e}")
+    finally:
+        if conn is not None:
+            pool.putconn(conn)
+
+
+class _Seen:
+    """
+    Ensemble des fichiers déjà pris en charge (partagé entre threads).
+    """
+
+    def __init__(self):
+        self._paths = set()
+        self._lock = threading.Lock()
+
+    def claim(self, path: str) -> bool:
+        with self._lock:
+            if path in self._paths:
+                return False
+            self._paths.add(path)
+            return True
+
+
+def _wait_stable(path: str, delay: float = 0.5) -> bool:
+    """
+    Attend que la taille du fichier ne bouge plus (copie terminée).
+    False si le fichier a disparu entre-temps.
+    """
+    size = -1
+    while True:
+        try:
+            cur = os.path.getsize(path)
+        except OSError:
+            return False
+        if cur == size:
+            return True
+        size = cur
+        time.sleep(delay)
+
+
+class _DropHandler(FileSystemEventHandler):
+    """
+    Pousse dans la file les fichiers créés / déplacés dans DROP_DIR.
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__()
+        self.q = q
+
+    def _push(self, path: str) -> None:
+        if os.path.splitext(path)[1].lower() in SUFFIXES:
+            self.q.put(path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._push(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._push(event.dest_path)
+
+
+def _list_drop_dir():
+    paths = glob.glob(os.path.join(DROP_DIR, "*.parquet")) + \
+        glob.glob(os.path.join(DROP_DIR, "*.csv"))
+    return sorted(paths)
+
+
+def _watch_events(pool, ex: ThreadPoolExecutor) -> None:
+    q = queue.Queue()
+    observer = Observer()
+    observer.schedule(_DropHandler(q), str(DROP_DIR), recursive=False)
+    observer.start()
+    # fichiers déjà présents, listés après le démarrage de l'observer : un
+    # fichier déposé entre-temps n'est pas perdu (doublon écarté par _Seen)
+    for path in _list_drop_dir():
+        q.put(path)
+    # dédoublonnage des événements (create + move d'un même fichier)
+    seen = _Seen()
+    try:
+        while True:
+            # attente bornée : sous Windows, un get() bloquant ne laisse pas
+            # passer Ctrl+C (observer.stop() jamais atteint)
+            try:
+                path = q.get(timeout=1)
+            except queue.Empty:
+                continue
+            if seen.claim(path):
+                ex.submit(process_one, pool, path, True)
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def _watch_polling(pool, ex: ThreadPoolExecutor) -> None:
+    seen = _Seen()
+    while True:
+        for path in _list_drop_dir():
+            if seen.claim(path):
+                ex.submit(process_one, pool, path)
+        time.sleep(3)
+
+
 def main():
     os.makedirs(DROP_DIR, exist_ok=True)
-    print(f"[watch] Surveillance de {DROP_DIR}")
-    seen = set()
-    conn = psycopg2.connect(**PG)
+    print(f"[watch] Surveillance de {DROP_DIR} ({WATCH_WORKERS} workers)")
+    pool = _get_pool()
+    ex = ThreadPoolExecutor(max_workers=WATCH_WORKERS)
 
     try:
-        while True:
-            paths = glob.glob(os.path.join(DROP_DIR, "*.parquet")) + \
-                glob.glob(os.path.join(DROP_DIR, "*.csv"))
-            for path in sorted(paths):
-                if path in seen:
-                    continue
-                try:
-                    df = read_any(path)
-                    inserted = upsert_dataframe(conn, df)
-                    print(
-                        f"[watch] {os.path.basename(path)} → upsert {inserted} lignes")
-                except Exception as e:
-                    print(f"[watch][ERREUR] {os.path.basename(path)}: {e}")
-                finally:
-                    seen.add(path)
-            time.sleep(3)
+        if Observer is not None:
+            _watch_events(pool, ex)
+        else:
+            print("[watch] watchdog non installé → polling toutes les 3 s")
+            _watch_polling(pool, ex)
     finally:
-        conn.close()
+        ex.shutdown(wait=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# Modules de med_demo/app importés par leur nom (comme entre eux)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "med_demo" / "app"))
+os.environ.setdefault("PGPASSWORD", "test")
@@ -0,0 +1,146 @@
+import http.client
+import io
+
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import parquet_http
+from parquet_http import RangeFile, get_byte_ranges
+
+N = 10_000
+
+
+def _parquet_bytes():
+    # 3 row groups, un par année ; fichier plus grand que FOOTER_PROBE
+    t = pa.table({
+        "annee": pa.array([2021] * N + [2022] * N + [2023] * N, pa.int64()),
+        "effectif": pa.array(range(3 * N), pa.int64()),
+        "libelle": pa.array([f"l{i}" for i in range(3 * N)]),
+    })
+    buf = io.BytesIO()
+    pq.write_table(t, buf, row_group_size=N, compression="none",
+                   use_dictionary=False)
+    return buf.getvalue()
+
+
+def _chunk_ranges(metadata, rg_index, columns):
+    rg = metadata.row_group(rg_index)
+    out = []
+    for j in range(rg.num_columns):
+        col = rg.column(j)
+        if col.path_in_schema in columns:
+            start = min(o for o in (col.dictionary_page_offset,
+                                    col.data_page_offset) if o)
+            out.append((start, start + col.total_compressed_size))
+    return out
+
+
+def test_get_byte_ranges_prunes_row_groups_by_year():
+    data = _parquet_bytes()
+    md = pq.ParquetFile(io.BytesIO(data)).metadata
+
+    ranges = get_byte_ranges(md, ["annee", "effectif"], gap=0, year=2022)
+
+    expected = _chunk_ranges(md, 1, {"annee", "effectif"})
+    covered = [(lo, hi) for lo, hi in ranges]
+    assert all(any(lo <= s and e <= hi for lo, hi in covered)
+               for s, e in expected)
+    for other in (0, 2):
+        for s, e in _chunk_ranges(md, other, {"annee", "effectif", "libelle"}):
+            assert all(e <= lo or s >= hi for lo, hi in covered)
+    assert get_byte_ranges(md, ["annee"], year=1999) == []
+
+
+def test_get_byte_ranges_coalesces_close_ranges():
+    md = pq.ParquetFile(io.BytesIO(_parquet_bytes())).metadata
+    assert len(get_byte_ranges(md, ["annee", "effectif"])) == 1
+    assert len(get_byte_ranges(md, ["annee", "effectif"], gap=0)) > 1
+
+
+def test_range_file_reads_fetched_ranges_then_falls_back(monkeypatch):
+    data = _parquet_bytes()
+    calls = []
+
+    def fake_get_range(url, start, end):
+        calls.append((start, end))
+        return data[start:end + 1]
+
+    monkeypatch.setattr(parquet_http, "_get_range", fake_get_range)
+
+    tail = data[-100:]
+    f = RangeFile("http://x/f.parquet", len(data), {len(data) - 100: tail})
+    f.seek(-10, io.SEEK_END)
+    assert f.read(10) == data[-10:]
+    assert calls == []
+
+    f.seek(5)
+    assert f.read(20) == data[5:25]
+    assert calls == [(5, 24)]
+
+    f.seek(10)
+    assert f.read(5) == data[10:15]
+    assert len(calls) == 1
+
+    f.seek(0)
+    table = pq.ParquetFile(f).read()
+    assert table.num_rows == 3 * N
+
+
+def _headers(*lines):
+    raw = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return http.client.parse_headers(io.BytesIO(raw))
+
+
+def test_open_parquet_url_rejects_206_without_content_range(monkeypatch):
+    data = _parquet_bytes()
+    monkeypatch.setattr(parquet_http, "_probe", lambda url: (
+        206, _headers("Content-Range: bytes */*"), data[-1024:], url))
+    with pytest.raises(IOError):
+        parquet_http.open_parquet_url("http://x/f.parquet", columns=["annee"])
+
+
+def test_open_parquet_url_reads_only_the_year(monkeypatch):
+    data = _parquet_bytes()
+    size = len(data)
+    calls = []
+
+    def fake_probe(url):
+        tail = data[-parquet_http.FOOTER_PROBE:]
+        # en-tête en minuscules : recherche insensible à la casse attendue
+        headers = _headers(
+            f"content-range: bytes {size - len(tail)}-{size - 1}/{size}")
+        return 206, headers, tail, url
+
+    def fake_get_range(url, start, end):
+        calls.append((start, end))
+        return data[start:end + 1]
+
+    monkeypatch.setattr(parquet_http, "_probe", fake_probe)
+    monkeypatch.setattr(parquet_http, "_get_range", fake_get_range)
+
+    frag = parquet_http.open_parquet_url("http://x/f.parquet",
+                                         columns=["annee", "effectif"],
+                                         year=2022)
+    schema = frag.physical_schema
+    tbl = frag.to_table(columns=["annee", "effectif"],
+                        filter=parquet_http.year_filter(schema, 2022))
+    assert tbl.column("annee").to_pylist() == [2022] * N
+    assert tbl.column("effectif").to_pylist() == list(range(N, 2 * N))
+    assert calls
+    md = pq.ParquetFile(io.BytesIO(data)).metadata
+    for other in (0, 2):
+        for s, e in _chunk_ranges(md, other, {"annee", "effectif"}):
+            assert all(e <= lo or s > hi for lo, hi in calls)
+
+
+def test_get_byte_ranges_prunes_on_date_and_text_years():
+    import datetime as dt
+    for annee in (pa.array([dt.date(2021, 1, 1)] * 2 + [dt.date(2022, 1, 1)] * 2),
+                  pa.array(["2021"] * 2 + ["2022-01-01"] * 2)):
+        buf = io.BytesIO()
+        pq.write_table(pa.table({"annee": annee}), buf, row_group_size=2)
+        md = pq.ParquetFile(io.BytesIO(buf.getvalue())).metadata
+        assert get_byte_ranges(md, gap=0, year=2022) == \
+            _chunk_ranges(md, 1, {"annee"})
+        assert get_byte_ranges(md, year=2020) == []
@@ -0,0 +1,77 @@
+import struct
+
+import pyarrow as pa
+
+from pg_copy import CopyBinaryStream, copy_table_binary
+
+
+COL_TYPES = {"a": "integer", "b": "bigint", "c": "real", "d": "text",
+             "e": "smallint", "f": "double precision"}
+
+
+def _expected(rows):
+    fmt = {"integer": "!ii", "bigint": "!iq", "real": "!if",
+           "smallint": "!ih", "double precision": "!id"}
+    out = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+    for row in rows:
+        out += struct.pack("!h", len(COL_TYPES))
+        for v, t in zip(row, COL_TYPES.values()):
+            if v is None:
+                out += struct.pack("!i", -1)
+            elif t == "text":
+                b = v.encode("utf-8")
+                out += struct.pack("!i", len(b)) + b
+            else:
+                out += struct.pack(fmt[t], struct.calcsize(fmt[t]) - 4, v)
+    return out + struct.pack("!h", -1)
+
+
+ROWS = [
+    (1, 2**40, 1.5, "Île-de-France", 7, 0.25),
+    (None, None, None, None, None, None),
+    (-3, -1, 2.0, "", 0, None),
+    (2022, 5, None, "31", None, -8.5),
+]
+
+
+def _table():
+    cols = list(zip(*ROWS))
+    return pa.table({name: list(values) for name, values in zip(COL_TYPES, cols)})
+
+
+def test_stream_matches_reference_encoding_byte_for_byte():
+    stream = CopyBinaryStream([_table()], COL_TYPES)
+    data = stream.read()
+    assert data == _expected(ROWS)
+    assert data[:19] == b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+    # 2e ligne : 6 champs NULL
+    assert b"\x00\x06" + b"\xff\xff\xff\xff" * 6 in data
+    assert data.endswith(b"\xff\xff")
+    assert stream.rows == len(ROWS)
+
+
+def test_stream_handles_sliced_batches_and_small_reads():
+    table = _table()
+    batches = [table.slice(0, 1), table.slice(1, 2), table.slice(3)]
+    stream = CopyBinaryStream(batches, COL_TYPES)
+    chunks = []
+    while True:
+        part = stream.read(7)
+        if not part:
+            break
+        chunks.append(part)
+    assert b"".join(chunks) == _expected(ROWS)
+
+
+def test_copy_table_binary_sends_stream_to_copy_expert():
+    class Cursor:
+        def copy_expert(self, sql, f, size):
+            self.sql = sql
+            self.data = f.read()
+
+    cur = Cursor()
+    assert copy_table_binary(cur, _table(), "tmp_stg", COL_TYPES,
+                             freeze=True) == len(ROWS)
+    assert cur.sql == ("COPY tmp_stg (a, b, c, d, e, f) FROM STDIN "
+                       "WITH (FORMAT BINARY, FREEZE TRUE)")
+    assert cur.data == _expected(ROWS)
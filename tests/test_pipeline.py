@@ -2,7 +2,7 @@ import sqlite3
 import pandas as pd
 
 
-def test_pipeline_loads_data(tmp_path):
+def test_pipeline_loads_data():
     # Simule un mini DataFrame comme le ferait staging_loader
     df = pd.DataFrame({
         "annee": [2022, 2022],
@@ -14,12 +14,19 @@ def test_pipeline_loads_data(tmp_path):
         "Effectif": [123, 456]
     })
 
-    # Connexion SQLite en fichier temporaire
-    db_file = tmp_path / "test.db"
-    conn = sqlite3.connect(db_file)
+    # Connexion SQLite en mémoire (pas d'I/O disque)
+    conn = sqlite3.connect(":memory:")
 
-    # Insertion en staging
-    df.to_sql("stg_pro_sante_raw", conn, if_exists="replace", index=False)
+    # Insertion en staging (table explicite, pas d'introspection to_sql)
+    conn.execute("""
+        CREATE TABLE stg_pro_sante_raw (
+            annee INTEGER, Region TEXT, Departement TEXT, profession TEXT,
+            classe_age TEXT, Genre TEXT, Effectif INTEGER
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO stg_pro_sante_raw VALUES (?,?,?,?,?,?,?)",
+        df.itertuples(index=False, name=None))
 
     # Vérification
     cur = conn.cursor()